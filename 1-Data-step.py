@@ -2,446 +2,1668 @@
 import pandas as pd
 import numpy as np
 import glob
-# import xarray as xr
+import xarray as xr
+import dask
 import os
+import json
+import sys
+import io
+import gzip
+import time
+import random
+import hashlib
+import collections
+import itertools
+import inspect
+import dis
+import ast
+import textwrap
+import pickle
+import threading
 import multiprocessing
+import shutil
+import atexit
+import resource
+import cProfile
+import contextlib
 import requests
-from dask import delayed, compute
+from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from functools import partial
 # from dask.distributed import Client
 # from distributed import Client
-import urllib.request 
 
 
 #%%
-def get_sst(file_loc, region, region_coords):
-    ### Creat new df and open file
-    ds = xr.open_dataset(file_loc)
-    df = ds.to_dataframe().reset_index()    
-    
+### Puerto Rico Regions [lon_min, lat_min, lon_max, lat_max]
+North = [-67.6538, 18.491170, -65.4236, 19.491170]
+West = [-68.1034, 17.7236, -67.1034, 18.74117]
+South = [-67.6538, 17.0288, -65.4236, 18.0288]
+East = [-65.929,  17.7236, -64.929, 18.74117]
+
+REGIONS = {'North': North, 'West': West, 'South': South, 'East': East}
+
+### Per-grid region index cache and area-weighted (cos-lat) gridded means
+REGION_CACHE = 'data/cache/regions'
+AREA_WEIGHTED = True
+EARTH_RADIUS = 6371.0088
+
+### Per-file regional subsets of the raw grids: compressed arrays on disk trimmed LRU to SUBSET_CACHE_MB,
+### and an in-memory LRU of SUBSET_MEMORY_MB per process (None disables the cache)
+SUBSET_CACHE = 'data/cache/subsets'
+SUBSET_CACHE_MB = 4096
+SUBSET_MEMORY_MB = 256
+
+### Worker processes for per-file extraction
+NCORES = max(1, multiprocessing.cpu_count() - 1)
+
+### Intermediate storage: 'csv' or 'parquet' (columnar, partitioned by variable/year/region)
+FILE_FORMAT = 'csv'
+COLUMNAR_ROOT = 'data/columnar'
+
+### PODAAC SSH granules: source, local archive and parallel connections
+SSH_URL = "https://podaac-opendap.jpl.nasa.gov/opendap/allData/merged_alt/L4/cdr_grid"
+SSH_DIR = '/data2/SSH/PODACC'
+SSH_CONNECTIONS = 4
+
+### Raw gridded archives
+GRIDDED = {'sst': '/data2/SST/NOAA_ESRL/DAILY/*.nc',
+           'chl': '/data2/CHL/NC/DAILY/*.nc',
+           'ssh': f'{SSH_DIR}/*.nc'}
+
+### NDBC historical standard meteorological archive, raw-file cache and download threads
+NDBC_URL = "https://www.ndbc.noaa.gov/data/historical/stdmet"
+NDBC_CACHE = 'data/cache/ndbc'
+NDBC_WORKERS = 8
+WIND_FAILURES = 'data/PR_Wind_failures.csv'
+
+### Fold gridded files straight into monthly moments instead of reading daily pixel tables
+STREAM_MONTHLY = True
+
+### Out-of-core mode: whole archives opened lazily and reduced in time chunks. CHUNK_TARGET sizes the chunks
+### (all workers' chunks plus their float64 temporaries come to about this much), it is not an enforced cap
+OUT_OF_CORE = False
+CHUNK_TARGET = '4GB'
+
+### Archive layout: variables, lat/lon/time names (CHL has one file per day and no time axis)
+ARCHIVES = {'sst': (['sst'], 'lat', 'lon', 'time'),
+            'chl': (['chlor_a'], 'lat', 'lon', None),
+            'ssh': (['SLA', 'SLA_ERR'], 'Latitude', 'Longitude', 'Time')}
+
+### Panel parameters: first year, conflict intensity threshold, species cutoff, FCCE events file
+START_YEAR = 2010
+CC_THRESHOLD = -1
+N_SPECIES = 300
+CC_FILE = 'data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv'
+# CC_FILE = 'data/FCCE_Master_Intensity_Expanded.csv'
+
+### Scenario batch: grid of panel parameters, one panel per combination (None runs the single panel only)
+### Keys: cc_file, start_year, max_year, threshold, min_intensity, n_species, species
+SCENARIOS = None
+# SCENARIOS = {'cc_file': [CC_FILE, 'data/FCCE_Master_Intensity_Expanded.csv'],
+#              'threshold': [-1, -3],
+#              'min_intensity': [None, 3],
+#              'max_year': [None, 2017],
+#              'n_species': [30, 300]}
+SCENARIO_DIR = 'data/scenarios'
+
+### Buoys per region and years for wind
+BUOYS = {'North': ["sjnp4", "arop4", "41053"],
+         'South': ["mgip4", "42085"],
+         'West': ["ptrp4", "41115", "mgzp4"],
+         'East': ["41056", "41052", "clbp4", "espp4"]}
+WIND_TASKS = [(x, y, region) for region, buoys in BUOYS.items() for x in buoys for y in range(2010, 2019)]
+
+### Stage cache for incremental rebuilds
+STAGE_CACHE = 'data/cache/stages'
+
+### Landings file, typed schema (only the columns the pipeline uses; nullable counts, blank cells are NA) and binary cache
+LANDINGS_FILE = 'data/PR_nonconf_landings_2010_19_2021-01-07.CSV'
+LANDINGS_DTYPES = {'YEAR_LANDED': 'int16',
+                   'MONTH_LANDED': 'int8',
+                   'LANDING_LOCATION_COUNTY': 'category',
+                   'ITIS_COMMON_NAME': 'category',
+                   'POUNDS_LANDED': 'float32',
+                   'ADJUSTED_POUNDS': 'float32',
+                   'trips': 'Int32',
+                   'fishers': 'Int32'}
+LANDINGS_CACHE = 'data/cache/landings'
+
+### Run reports (JSON + CSV per run), seconds between progress lines, parent-process profiler (None, 'cprofile', 'pyinstrument')
+REPORT_DIR = 'data/reports'
+PROGRESS_EVERY = 10
+PROFILER = None
+
+### Daily regional datasets: csv path and value columns
+DAILY = {'sst': ('data/PR_SST_daily_regional_2010-2019.csv', ['sst']),
+         'chl': ('data/PR_CHL_daily_regional_2010_2019.csv', ['chlor_a']),
+         'wind': ('data/PR_Wind_daily_regional_2010-2019', ['WDIR', 'WSPD']),
+         'ssh': ('data/PR_SSH_5day_regional_2010-2019', ['sla', 'sla_err'])}
+
+
+#%%
+### Instrumentation: the run report of the current run (set in __main__, None when imported)
+REPORT = None
+
+
+def log(msg):
+    ### Timestamped progress line, also kept in the run report
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+    if REPORT is not None:
+        REPORT.events.append({'time': time.time(), 'stage': REPORT.stage_name, 'message': msg})
+
+
+def rss_mb():
+    ### Current resident memory of this process (Linux /proc, else the high-water mark)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    ### Reset this process's RSS high-water mark (Linux /proc/self/clear_refs); False where not allowed
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    ### RSS high-water mark since the last reset_peak_rss (VmHWM)
+    with open('/proc/self/status') as f:
+        return next(int(x.split()[1]) for x in f if x.startswith('VmHWM:')) / 1024
+
+
+def io_bytes():
+    ### Bytes read by this process so far (/proc/self/io), None where unavailable
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(x.split(': ') for x in f.read().splitlines())['rchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def count_rows(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, dict):
+        value = tuple(value.values())
+    if isinstance(value, (tuple, list)):
+        rows = [count_rows(x) for x in value]
+        return sum(x for x in rows if x is not None) if any(x is not None for x in rows) else None
+    return None
+
+
+def probed(func, file_, *args, **kwargs):
+    ### func(file_) with its wall/CPU time, own memory peak, bytes read and rows out. Memory and reads are
+    ### per process: measured for tasks on a process's main thread (pool workers), left empty for tasks
+    ### sharing a process with other threads, where they would mix in the other tasks
+    own = threading.current_thread() is threading.main_thread()
+    reset = own and reset_peak_rss()
+    rss0 = rss_mb()
+    wall, cpu, read = time.perf_counter(), time.thread_time(), io_bytes() if own else None
+    value = func(file_, *args, **kwargs)
+    peak = peak_rss_mb() if reset else None
+    record = {'file': file_ if isinstance(file_, str) else ' '.join(map(str, file_)), 'pid': os.getpid(),
+              'seconds': time.perf_counter() - wall, 'cpu_seconds': time.thread_time() - cpu,
+              'peak_rss_mb': peak, 'rss_delta_mb': max(peak - rss0, 0) if peak is not None else None,
+              'bytes_read': io_bytes() - read if read is not None else None,
+              'file_bytes': os.path.getsize(file_) if isinstance(file_, str) and os.path.exists(file_) else None,
+              'rows_out': count_rows(value)}
+    return value, record
+
+
+class Progress:
+    ### Items done, throughput and ETA, printed at most every PROGRESS_EVERY seconds
+    def __init__(self, label, total, every=PROGRESS_EVERY):
+        self.label = label
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.nbytes = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, n=1, nbytes=None):
+        self.done += n
+        self.nbytes += nbytes or 0
+        now = time.perf_counter()
+        if now - self.last >= self.every or self.done == self.total:
+            self.last = now
+            elapsed = now - self.start
+            rate = self.done / elapsed if elapsed > 0 else 0
+            eta = (self.total - self.done) / rate if rate > 0 else float('nan')
+            throughput = f", {self.nbytes / 2 ** 20 / max(elapsed, 1e-9):.1f} MB/s" if self.nbytes else ""
+            eta = f"{int(eta // 3600)}:{int(eta % 3600 // 60):02d}:{int(eta % 60):02d}" if eta == eta else "?"
+            log(f"{self.label}: {self.done}/{self.total} ({self.done / max(self.total, 1):.0%}), {rate:.2f}/s{throughput}, ETA {eta}")
+
+
+class RunReport:
+    ### Per-stage and per-file records for one run, written as JSON and CSV on exit
+    def __init__(self, report_dir=REPORT_DIR, profiler=PROFILER, sample_every=0.2):
+        self.report_dir = report_dir
+        self.profiler = profiler
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.started = time.time()
+        self.stages = []
+        self.files = []
+        self.events = []
+        self.stage_name = None
+        self.peak = 0
+
+        ### Background sampler for the current-stage RSS peak
+        def sample():
+            while True:
+                self.peak = max(self.peak, rss_mb())
+                time.sleep(sample_every)
+        threading.Thread(target=sample, daemon=True).start()
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        ### Yields the stage record so the caller can add rows_out, cached, key, ...
+        record = {'stage': name, **fields}
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall, cpu, read = time.perf_counter(), time.process_time(), io_bytes()
+        nfiles = len(self.files)
+        self.stage_name, self.peak = name, rss_mb()
+        profiler = self.start_profiler()
+        try:
+            yield record
+        finally:
+            self.stop_profiler(profiler, name)
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            ### Worker-process files add their own reads and memory; thread-run files are already in ours
+            files = self.files[nfiles:]
+            workers = [x for x in files if x['pid'] != os.getpid()]
+            record.update({'seconds': time.perf_counter() - wall,
+                           'cpu_seconds': time.process_time() - cpu,
+                           'worker_cpu_seconds': round(after.ru_utime + after.ru_stime - children.ru_utime - children.ru_stime, 6),
+                           'peak_rss_mb': max(self.peak, rss_mb()),
+                           'worker_peak_rss_mb': max([x['peak_rss_mb'] for x in workers if x['peak_rss_mb'] is not None], default=None),
+                           'bytes_read': (io_bytes() - read if read is not None else 0) + sum(x['bytes_read'] or 0 for x in workers),
+                           'files': len(files)})
+            self.stages.append(record)
+            self.stage_name = None
+
+    def add_file(self, record):
+        self.files.append({'stage': self.stage_name, **record})
+
+    def start_profiler(self):
+        ### Parent process only; worker processes show up as per-file records
+        if self.profiler == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler(interval=0.005)
+            profiler.start()
+            return profiler
+        return None
+
+    def stop_profiler(self, profiler, name):
+        if profiler is None:
+            return
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f'{self.run_id}-{name}')
+        if self.profiler == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+        else:
+            profiler.stop()
+            with open(path + '.html', 'w') as f:
+                f.write(profiler.output_html())
+
+    def write(self):
+        ### <run_id>.json (everything), <run_id>-stages.csv and <run_id>-files.csv
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, self.run_id)
+        report = {'run_id': self.run_id, 'started': self.started, 'seconds': time.time() - self.started,
+                  'ncores': NCORES, 'pid': os.getpid(), 'host': os.uname().nodename,
+                  'stages': self.stages, 'files': self.files, 'events': self.events}
+        with open(path + '.json', 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        pd.DataFrame(self.stages).to_csv(path + '-stages.csv', index=False)
+        pd.DataFrame(self.files).to_csv(path + '-files.csv', index=False)
+        print(f"Run report: {path}.json")
+
+
+#%%
+def load_regions(path, name_field):
+    ### Polygon regions {name: GeoJSON geometry} from a GeoJSON file or shapefile
+    if path.endswith('.shp'):
+        import geopandas as gpd
+        features = json.loads(gpd.read_file(path).to_crs(epsg=4326).to_json())['features']
+    else:
+        with open(path) as f:
+            features = json.load(f)['features']
+    return {x['properties'][name_field]: x['geometry'] for x in features}
+
+
+def region_geometry(coords):
+    ### Box [lon_min, lat_min, lon_max, lat_max] or GeoJSON (Multi)Polygon -> polygons of closed lon/lat rings
+    if isinstance(coords, dict):
+        polygons = coords['coordinates'] if coords['type'] == 'MultiPolygon' else [coords['coordinates']]
+    else:
+        lon0, lat0, lon1, lat1 = coords
+        polygons = [[[[lon0, lat0], [lon1, lat0], [lon1, lat1], [lon0, lat1]]]]
+
+    outdat = []
+    for polygon in polygons:
+        rings = [np.asarray(ring, dtype=float)[:, :2] for ring in polygon]
+        outdat.append([ring if (ring[0] == ring[-1]).all() else np.vstack([ring, ring[:1]]) for ring in rings])
+    return outdat
+
+
+def in_polygon(lon, lat, rings):
+    ### Even-odd ray casting, holes are the inner rings
+    inside = np.zeros(len(lon), dtype=bool)
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+            cross = (y0 > lat) != (y1 > lat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = x0 + (lat - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= cross & (lon < x)
+    return inside
+
+
+def region_area(coords, radius=EARTH_RADIUS):
+    ### Area (km2) on the sphere, exact for boxes and for polygons with parallel/meridian edges
+    area = 0
+    for polygon in region_geometry(coords):
+        for i, ring in enumerate(polygon):
+            lon, lat = np.radians(ring[:, 0]), np.radians(ring[:, 1])
+            ring_area = abs(np.sum((lon[1:] - lon[:-1]) * (np.sin(lat[1:]) + np.sin(lat[:-1])) / 2))
+            area += ring_area if i == 0 else -ring_area
+    return area * radius ** 2
+
+
+def cell_spacing(coord, period=None):
+    ### Grid spacing (degrees) around each cell centre; with a period (360 for longitudes) steps across
+    ### the seam count as the short way round
+    if len(coord) < 2:
+        return np.ones(len(coord))
+    step = np.diff(coord)
+    if period is not None:
+        step = (step + period / 2) % period - period / 2
+    step = np.abs(step)
+    return np.concatenate([step[:1], (step[:-1] + step[1:]) / 2, step[-1:]])
+
+
+_region_indexes = {}
+
+
+def region_index(lats, lons, regions, cache_dir=REGION_CACHE):
+    ### Per-region cell positions (lat, lon) and cos-lat cell areas (km2), built once per grid and cached
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    lons = np.where(lons > 180, -360 + lons, lons)
+    key = hashlib.sha1(lats.tobytes() + lons.tobytes() + json.dumps(regions, sort_keys=True).encode()).hexdigest()
+    if key in _region_indexes:
+        return _region_indexes[key]
+
+    path = os.path.join(cache_dir, f'{key}.npz')
+    if os.path.exists(path):
+        with np.load(path) as f:
+            index = {region: (f[f'{region}_lat'], f[f'{region}_lon'], f[f'{region}_weight']) for region in regions}
+    else:
+        dlat = np.radians(cell_spacing(lats))
+        dlon = np.radians(cell_spacing(lons, period=360))
+        index = {}
+        for region, coords in regions.items():
+            polygons = region_geometry(coords)
+            bounds = np.vstack([ring for polygon in polygons for ring in polygon])
+            ilat = np.flatnonzero((lats >= bounds[:, 1].min()) & (lats <= bounds[:, 1].max()))
+            ilon = np.flatnonzero((lons >= bounds[:, 0].min()) & (lons <= bounds[:, 0].max()))
+            ilat, ilon = [x.ravel() for x in np.meshgrid(ilat, ilon, indexing='ij')]
+
+            ### Boxes keep every cell of the window (inclusive edges), polygons test cell centres
+            if isinstance(coords, dict):
+                keep = np.zeros(len(ilat), dtype=bool)
+                for polygon in polygons:
+                    keep |= in_polygon(lons[ilon], lats[ilat], polygon)
+                ilat, ilon = ilat[keep], ilon[keep]
+
+            weight = EARTH_RADIUS ** 2 * np.cos(np.radians(lats[ilat])) * dlat[ilat] * dlon[ilon]
+            index[region] = (ilat, ilon, weight)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        ### Per-process temp name, partition workers build the same index concurrently on a cold cache
+        ### Arrays are stored under the region name, the key ignores the order of the regions
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **{f'{region}_{x}': y for region in regions for x, y in zip(['lat', 'lon', 'weight'], index[region])})
+        os.replace(tmp, path)
+
+    _region_indexes[key] = index
+    return index
+
+
+#%%
+def read_cells(ds, variables, lat, lon, ilat, ilon):
+    ### Variables at the given cells along a 'cell' dimension, from one read of the window covering them
+    lat0, lon0 = (ilat.min(), ilon.min()) if len(ilat) else (0, 0)
+    window = {lat: slice(lat0, ilat.max() + 1 if len(ilat) else 0), lon: slice(lon0, ilon.max() + 1 if len(ilon) else 0)}
+    sub = ds[variables].isel(window).load()
+    return sub.isel({lat: xr.DataArray(ilat - lat0, dims='cell'), lon: xr.DataArray(ilon - lon0, dims='cell')})
+
+
+class SubsetCache:
+    ### Cells already read from each raw file, keyed on the file (path, mtime, size) and the variables.
+    ### Entries hold sorted flat cell keys (ilat * nlon + ilon) and one typed array per variable (cell axis
+    ### last), so any region set reuses the cells it shares with earlier ones and only new cells are read
+    ### Sizes are tracked as entries come and go, so puts never re-sum memory or rescan the directory: files
+    ### are indexed once (oldest mtime first) and again every rescan_every puts, to see other workers' writes
+    def __init__(self, cache_dir=SUBSET_CACHE, max_mb=SUBSET_CACHE_MB, memory_mb=SUBSET_MEMORY_MB, rescan_every=256):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 2 ** 20
+        self.memory_bytes = memory_mb * 2 ** 20
+        self.rescan_every = rescan_every
+        self.memory = collections.OrderedDict()
+        self.memory_total = 0
+        self.files = None
+        self.disk_total = 0
+        self.puts = 0
+
+    def key(self, file_, variables, lat, lon):
+        stat = os.stat(file_)
+        stamp = f"{os.path.abspath(file_)}|{stat.st_mtime_ns}|{stat.st_size}|{sorted(variables)}|{lat}|{lon}"
+        return hashlib.sha1(stamp.encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        path = os.path.join(self.cache_dir, f'{key}.npz')
+        try:
+            with np.load(path) as f:
+                entry = {x: f[x] for x in f.files}
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        if self.files is not None and key in self.files:
+            self.files.move_to_end(key)
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, f'{key}.npz')
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **entry)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        self.remember(key, entry)
+
+        if self.files is None or self.puts % self.rescan_every == 0:
+            self.scan()
+        else:
+            self.disk_total += size - self.files.pop(key, 0)
+            self.files[key] = size
+        self.puts += 1
+        self.trim()
+
+    def remember(self, key, entry):
+        if key in self.memory:
+            self.memory_total -= sum(x.nbytes for x in self.memory.pop(key).values())
+        self.memory[key] = entry
+        self.memory_total += sum(x.nbytes for x in entry.values())
+        while len(self.memory) > 1 and self.memory_total > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_total -= sum(x.nbytes for x in evicted.values())
+
+    def scan(self):
+        ### Index the cached files, least recently used (by mtime, touched on every hit) first
+        files = []
+        for x in os.scandir(self.cache_dir):
+            if x.name.endswith('.npz'):
+                try:
+                    stat = x.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, x.name[:-len('.npz')], stat.st_size))
+        self.files = collections.OrderedDict((key, size) for _, key, size in sorted(files))
+        self.disk_total = sum(self.files.values())
+
+    def trim(self):
+        ### Evict least recently used files beyond the size limit
+        while len(self.files) > 1 and self.disk_total > self.max_bytes:
+            key, size = self.files.popitem(last=False)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.cache_dir, f'{key}.npz'))
+            self.disk_total -= size
+
+    def cells(self, ds, file_, variables, lat, lon, keys):
+        ### Variables at the sorted flat cell keys, reading only the cells not cached yet
+        nlon = ds.sizes[lon]
+        if len(keys) == 0:
+            ### No region holds a cell of this grid, nothing to cache
+            return read_cells(ds, variables, lat, lon, keys // nlon, keys % nlon).transpose(..., 'cell')
+        key = self.key(file_, variables, lat, lon)
+        entry = self.get(key)
+        missing = keys if entry is None else keys[~np.isin(keys, entry['cells'])]
+        if len(missing):
+            new = read_cells(ds, variables, lat, lon, missing // nlon, missing % nlon).transpose(..., 'cell')
+            new = {'cells': missing, **{x: new[x].values for x in variables}}
+            if entry is not None:
+                order = np.argsort(np.concatenate([entry['cells'], missing]), kind='stable')
+                new = {x: np.concatenate([entry[x], new[x]], axis=-1)[..., order] for x in new}
+            entry = new
+            self.put(key, entry)
+
+        ### Coordinates from a lazy index of the file, values from the cache
+        template = ds[variables].isel({lat: xr.DataArray(keys // nlon, dims='cell'),
+                                       lon: xr.DataArray(keys % nlon, dims='cell')}).transpose(..., 'cell')
+        pos = np.searchsorted(entry['cells'], keys)
+        return template.copy(data={x: entry[x][..., pos] for x in variables})
+
+
+_subset_caches = {}
+
+
+def subset_cache():
+    ### This process's subset cache for the current settings, None when disabled
+    if SUBSET_CACHE is None:
+        return None
+    settings = (SUBSET_CACHE, SUBSET_CACHE_MB, SUBSET_MEMORY_MB)
+    if settings not in _subset_caches:
+        _subset_caches[settings] = SubsetCache(*settings)
+    return _subset_caches[settings]
+
+
+def gather_cells(ds, variables, index, lat, lon):
+    ### Sorted flat keys of every region's cells and the variables at those cells, through the subset cache
+    nlon = ds.sizes[lon]
+    keys = np.unique(np.concatenate([x[0] * nlon + x[1] for x in index.values()] + [np.zeros(0, dtype=int)]))
+    cache = subset_cache()
+    source = ds.encoding.get('source')
+    if cache is not None and source is not None:
+        return keys, cache.cells(ds, source, variables, lat, lon, keys)
+    return keys, read_cells(ds, variables, lat, lon, keys // nlon, keys % nlon)
+
+
+def extract_regions(ds, variables, regions, lat='lat', lon='lon'):
+    ### Region-labelled long table with each cell's area weight, read through the grid's region index
+    index = region_index(ds[lat].values, ds[lon].values, regions)
+    keys, sub = gather_cells(ds, variables, index, lat, lon)
+
+    ### Rows in the variable's own dimension order, as to_dataframe gives them
+    dims = ds[variables[0]].dims
+    columns = [x for x in dims if x not in (lat, lon)] + [x for x in dims if x in (lat, lon)] + variables + ['weight']
+
+    outdat = []
+    for region, (ilat, ilon, weight) in index.items():
+        order = np.lexsort((ilat, ilon)) if dims.index(lon) < dims.index(lat) else np.arange(len(ilat))
+        pos = np.searchsorted(keys, ilat[order] * ds.sizes[lon] + ilon[order])
+        df = sub.isel(cell=pos).assign(weight = ('cell', weight[order])).to_dataframe().reset_index()
+        outdat.append(df[columns].assign(region = region))
+
+    outdat = pd.concat(outdat).reset_index(drop=True)
+
     ### Convert 0-360 to -180 - 180
-    df.loc[:, 'lon'] = np.where(df['lon'] > 180, -360 + df['lon'], df['lon'])
+    outdat.loc[:, lon] = np.where(outdat[lon] > 180, -360 + outdat[lon], outdat[lon])
+    return outdat
+
+
+#%%
+def get_sst(file_loc, regions=REGIONS):
+    ### Open file once and read only the region windows
+    with xr.open_dataset(file_loc) as ds:
+        df = extract_regions(ds, ['sst'], regions)
 
-    ### Filter region
-    df = df[(df['lat'] >= region_coords[1]) & (df['lat'] <= region_coords[3])]
-    df = df[(df['lon'] >= region_coords[0]) & (df['lon'] <= region_coords[2])]
-    
     ### New var columns
-    df = df.assign(date = df['time'], region = region)
-    df = df[['date', 'region', 'lon', 'lat', 'sst']]
+    df = df.assign(date = df['time'])
+    df = df[['date', 'region', 'lon', 'lat', 'sst', 'weight']]
 
     return df
 
 
 #%%
-def proc_sst():
-    ### SST
-    files = sorted(glob.glob('/data2/SST/NOAA_ESRL/DAILY/*.nc'))
+def gridded_files(variable):
+    files = sorted(glob.glob(GRIDDED[variable]))
 
-    # 2010-2019
-    files = files[10:20]
+    # 2010-2019 (the out-of-core mode reads the whole archive)
+    if variable == 'sst' and not OUT_OF_CORE:
+        files = files[10:20]
+    return files
 
-    ### North region
-    north_df = [get_sst(x, "North", North) for x in files]
-    north_res = pd.concat([d for d in north_df])
-    print(f"North Region SST Processed")
 
-    ### West region
-    west_df = [get_sst(x, "West", West) for x in files]
-    west_res = pd.concat([d for d in west_df])
-    print(f"West Region SST Processed")
+def archive_files(variable):
+    ### Raw files for the modes that read the gridded archives directly, failing early on an empty glob
+    files = gridded_files(variable)
+    if not files:
+        raise FileNotFoundError(f"No {variable} files match GRIDDED['{variable}'] = {GRIDDED[variable]!r}")
+    return files
 
-    ### South region
-    south_df = [get_sst(x, "South", South) for x in files]
-    south_res = pd.concat([d for d in south_df])
-    print(f"South Region SST Processed")
 
-    ### East region
-    east_df = [get_sst(x, "East", East) for x in files]
-    east_res = pd.concat([d for d in east_df])
-    print(f"East Region SST Processed")
+#%%
+def proc_sst(regions=REGIONS, ncores=NCORES):
+    ### SST
+    files = gridded_files('sst')
 
-    retdat = pd.concat([north_res, west_res, south_res, east_res])
-    retdat = retdat.reset_index(drop=True)
+    ### One partition per file, all regions per file
+    parts = run_partitioned(partial(get_sst, regions=regions), files, 'data/partitions/sst', ncores=ncores)
+    combine_partitions(parts, 'sst')
+    log(f"SST Processed: {', '.join(regions)}")
     
-    return retdat
+    return parts
 
 
 #%%
-def get_chl(file_, north_region, south_region, east_region, west_region):
+def get_chl(file_, regions=REGIONS):
     ### Get year-day
     year_day = os.path.splitext(os.path.basename(file_))[0].split('.')[0][-7:8]
     year = year_day[-7:4]
     day = year_day[5:8]
     month =  pd.to_datetime(year_day, format="%Y%j").month
 
-    ### Get nc file
-    ds = xr.open_dataset(file_, drop_variables=['palette'])
-    df = ds.to_dataframe().reset_index()
-
-    ### Subset Northern Region
-    ndf = df[(df['lat'] >= north_region[1]) & (df['lat'] <= north_region[3])]
-    ndf = ndf[(ndf['lon'] >= north_region[0]) & (ndf['lon'] <= north_region[2])]
-    ndf = ndf.assign(region = "North", year = year, month=month, day=day)    
-
-    ### Subset Southern Region
-    sdf = df[(df['lat'] >= south_region[1]) & (df['lat'] <= south_region[3])]
-    sdf = sdf[(sdf['lon'] >= south_region[0]) & (sdf['lon'] <= south_region[2])]
-    sdf = sdf.assign(region = "South", year = year, month=month, day=day)   
-
-    ### Subset Eastern Region
-    edf = df[(df['lat'] >= east_region[1]) & (df['lat'] <= east_region[3])]
-    edf = edf[(edf['lon'] >= east_region[0]) & (edf['lon'] <= east_region[2])]
-    edf = edf.assign(region = "East", year = year, month=month, day=day)   
-
-    ### Subset Western Region
-    wdf = df[(df['lat'] >= west_region[1]) & (df['lat'] <= west_region[3])]
-    wdf = wdf[(wdf['lon'] >= west_region[0]) & (wdf['lon'] <= west_region[2])]
-    wdf = wdf.assign(region = "West", year = year, month=month, day=day)   
-    
-    ### Bind Regions
-    outdat = pd.concat([ndf, sdf, edf, wdf]).reset_index(drop=True)
-    print(f"{year}" + f"-{month}".zfill(3) + f"-{day}".zfill(3))
+    ### Get nc file, read only the region windows
+    with xr.open_dataset(file_, drop_variables=['palette']) as ds:
+        outdat = extract_regions(ds, list(ds.data_vars), regions)
+
+    outdat = outdat.assign(year = year, month=month, day=day)
     return outdat
 
 
 
 #%%
-def get_wind(dat):
+class FetchError(Exception):
+    def __init__(self, url, attempts, reason):
+        super().__init__(f"{url}: {reason} after {attempts} attempt(s)")
+        self.url = url
+        self.attempts = attempts
+        self.reason = reason
+
+
+_sessions = threading.local()
+
+
+def get_session(pool_size=NDBC_WORKERS):
+    ### One pooled keep-alive session per worker thread
+    if not hasattr(_sessions, 'session'):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions.session = session
+    return _sessions.session
+
+
+def fetch_url(url, retries=6, backoff=1.0, timeout=60):
+    ### GET with exponential backoff and full jitter; 4xx other than 429 is not retried
+    for attempt in range(1, retries + 1):
+        try:
+            resp = get_session().get(url, timeout=timeout)
+        except requests.RequestException as e:
+            reason = repr(e)
+        else:
+            if resp.status_code == 200:
+                return resp.content
+            reason = f"HTTP {resp.status_code}"
+            if resp.status_code < 500 and resp.status_code != 429:
+                raise FetchError(url, attempt, reason)
+        if attempt < retries:
+            log(f"Failed: {url} ({reason}) ... retrying {attempt}")
+            time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+    raise FetchError(url, retries, reason)
+
+
+#%%
+def write_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def cached_fetch(url, cache_dir=NDBC_CACHE):
+    ### Content-addressed cache: refs/<sha1(url)> holds the sha256 of objects/<sha256>
+    ref = os.path.join(cache_dir, 'refs', hashlib.sha1(url.encode()).hexdigest())
+    if os.path.exists(ref):
+        with open(ref) as f:
+            digest = f.read().strip()
+        if digest == 'missing':
+            raise FetchError(url, 0, "HTTP 404 (cached)")
+        obj = os.path.join(cache_dir, 'objects', digest[:2], digest)
+        if os.path.exists(obj):
+            with open(obj, 'rb') as f:
+                return f.read()
+
+    try:
+        content = fetch_url(url)
+    except FetchError as e:
+        ### Remember missing buoy-years so reruns don't ask again
+        if e.reason == "HTTP 404":
+            write_atomic(ref, b'missing')
+        raise
+
+    digest = hashlib.sha256(content).hexdigest()
+    write_atomic(os.path.join(cache_dir, 'objects', digest[:2], digest), content)
+    write_atomic(ref, digest.encode())
+    return content
+
+
+#%%
+def parse_stdmet(raw):
+    ### NDBC historical stdmet text (gzipped or plain) -> time, WDIR, WSPD as float32, sentinels as NaN
+    ### Header variants: '#YY MM DD hh mm WDIR ...' + units row (2007+), 'YYYY MM DD hh [mm] WD ...', 'YY MM DD hh WD ...'
+    text = gzip.decompress(raw) if raw[:2] == b'\x1f\x8b' else raw
+    lines = text.split(b'\n', 2)
+    columns = lines[0].decode().lstrip('#').split()
+    skip = 2 if len(lines) > 1 and lines[1].startswith(b'#') else 1
+
+    names = {'YY': 'year', 'YYYY': 'year', 'MM': 'month', 'DD': 'day', 'hh': 'hour', 'mm': 'minute',
+             'WDIR': 'WDIR', 'WD': 'WDIR', 'WSPD': 'WSPD'}
+    usecols = [i for i, x in enumerate(columns) if x in names]
+    df = pd.read_csv(io.BytesIO(text), sep=r'\s+', header=None, skiprows=skip, usecols=usecols,
+                     names=[names.get(x, x) for x in columns], dtype='float64',
+                     na_values={'WDIR': [999], 'WSPD': [99]}, keep_default_na=False)
+
+    ### Timestamps by datetime64 arithmetic (two-digit years are 19xx)
+    year = df['year'].to_numpy('int64')
+    year = np.where(year < 100, year + 1900, year)
+    month = (year - 1970) * 12 + df['month'].to_numpy('int64') - 1
+    minutes = df['hour'].to_numpy('int64') * 60 + (df['minute'].to_numpy('int64') if 'minute' in df.columns else 0)
+    time_ = (month.astype('datetime64[M]').astype('datetime64[D]') + (df['day'].to_numpy('int64') - 1)
+             + minutes.astype('timedelta64[m]')).astype('datetime64[ns]')
+    return pd.DataFrame({'time': time_, 'WDIR': df['WDIR'].astype('float32'), 'WSPD': df['WSPD'].astype('float32')})
+
+
+def daily_wind(df):
+    ### Daily mean speed and speed-weighted vector-mean direction (meteorological, degrees from north)
+    days, day = np.unique(df['time'].to_numpy().astype('datetime64[D]'), return_inverse=True)
+    spd = df['WSPD'].to_numpy('float64')
+    theta = np.radians(df['WDIR'].to_numpy('float64'))
+    has_spd = ~np.isnan(spd)
+    valid = has_spd & ~np.isnan(theta)
+
+    n = np.bincount(day, weights=has_spd, minlength=len(days))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wspd = np.bincount(day, weights=np.where(has_spd, spd, 0), minlength=len(days)) / n
+    u = np.bincount(day, weights=np.where(valid, spd * np.sin(theta), 0), minlength=len(days))
+    v = np.bincount(day, weights=np.where(valid, spd * np.cos(theta), 0), minlength=len(days))
+    wdir = np.round(np.degrees(np.arctan2(u, v)), 6) % 360
+    wdir = np.where(np.bincount(day, weights=valid, minlength=len(days)) > 0, wdir, np.nan)
+    return pd.DataFrame({'date': days.astype('datetime64[ns]'), 'WDIR': wdir.astype('float32'), 'WSPD': wspd.astype('float32')})
+
+
+def get_wind(dat, base_url=NDBC_URL, cache_dir=NDBC_CACHE, daily=True):
     buoy_id = dat[0]
     year = dat[1]
     region = dat[2]
-    for i in range(10):
-        try:
-            url = f"https://www.ndbc.noaa.gov/data/historical/stsdmet/{buoy_id}h{year}.txt.gz"
-            df = pd.read_csv(url, compression='gzip', sep=" ", header=0, skipinitialspace=True)
-            df = df.iloc[1:]
-            date = df['#YY'].astype(str) + "-" + df['MM'].astype(str) + "-" + df['DD'].astype(str)
-            df = df.assign(date = date, buoy_id = buoy_id, region = region)
-            outdat = df[['date', 'buoy_id', 'region', 'WDIR', 'WSPD']]
-            return outdat
-        except:
-            print(f"Failed: {buoy_id} - {year} - {region} ... retrying {i}")
-            continue
+    url = f"{base_url}/{buoy_id}h{year}.txt.gz"
+    df = parse_stdmet(cached_fetch(url, cache_dir))
+    df = daily_wind(df) if daily else df.rename(columns={'time': 'date'})
+    df = df.assign(buoy_id = buoy_id, region = region)
+    outdat = df[['date', 'buoy_id', 'region', 'WDIR', 'WSPD']]
+    return outdat
+
+
+def fetch_wind(tasks, max_workers=NDBC_WORKERS, base_url=NDBC_URL, cache_dir=NDBC_CACHE):
+    ### Bounded thread pool over (buoy, year, region); returns data and a per-task failure report
+    results = {}
+    failures = []
+    progress = Progress('Wind', len(tasks))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(probed, get_wind, task, base_url, cache_dir): i for i, task in enumerate(tasks)}
+        for fut in as_completed(futures):
+            buoy_id, year, region = tasks[futures[fut]]
+            progress.update()
+            try:
+                results[futures[fut]], record = fut.result()
+                if REPORT is not None:
+                    REPORT.add_file(record)
+            except Exception as e:
+                failures.append({'buoy_id': buoy_id, 'year': year, 'region': region,
+                                 'url': getattr(e, 'url', None), 'attempts': getattr(e, 'attempts', None),
+                                 'error': getattr(e, 'reason', repr(e))})
+
+    failures = pd.DataFrame(failures, columns=['buoy_id', 'year', 'region', 'url', 'attempts', 'error'])
+    log(f"Wind: {len(results)} of {len(tasks)} buoy-years fetched, {len(failures)} failed")
+    if len(failures) > 0:
+        log("\n" + failures.to_string(index=False))
+
+    ### Keep task order regardless of completion order
+    wind_dat = pd.concat([results[i] for i in sorted(results)]).reset_index(drop=True) if results else pd.DataFrame()
+    return wind_dat, failures
 
 
 #%%
-def download_ssh_data():
+def list_ssh_granules():
     url = "https://podaac.jpl.nasa.gov/ws/search/granule?datasetId=PODAAC-SLREF-CDRV2&startTime=2009-12-01&endTime=2019-12-31&itemsPerPage=2000&sortBy=ascending&format=html&pretty=true"
-    reqs = requests.get(url)
+    reqs = get_session().get(url, timeout=60)
+    reqs.raise_for_status()
     soup = BeautifulSoup(reqs.text, 'lxml')   
     files = []
     for heading in soup.find_all(["h2"]):
         files.extend(heading)
         
-    files = sorted(files)
-    
-    for file_ in files:
-        filename = f"https://podaac-opendap.jpl.nasa.gov/opendap/allData/merged_alt/L4/cdr_grid/{file_}"
-        urllib.request.urlretrieve(filename, f"/data2/SSH/PODACC/{file_}")
-    print(file_)
+    return sorted(str(x).strip() for x in files)
+
+
+def download_file(url, dest, md5=None, chunk_size=1 << 20, timeout=120):
+    ### Stream into dest.part, resuming with a Range request if a partial file is there
+    part = dest + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+
+    with get_session().get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code == 416:
+            ### Partial file already holds everything, verify it below
+            total = offset
+        else:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                offset = 0
+            length = resp.headers.get('Content-Length')
+            total = offset + int(length) if length is not None else None
+            with open(part, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in resp.iter_content(chunk_size):
+                    f.write(chunk)
+
+    ### Verify size and checksum before the atomic rename
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        raise IOError(f"{url}: got {size} of {total} bytes")
+    digest = hashlib.md5()
+    with open(part, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    if md5 is not None and digest.hexdigest() != md5:
+        os.remove(part)
+        raise IOError(f"{url}: md5 {digest.hexdigest()} does not match {md5}")
+
+    os.replace(part, dest)
+    return {'size': size, 'md5': digest.hexdigest()}
+
+
+def download_granule(name, out_dir, base_url=SSH_URL, retries=5, backoff=2.0):
+    url = f"{base_url}/{name}"
+
+    ### Published .md5 next to the granule, size check only if there is none
+    try:
+        md5 = fetch_url(url + '.md5').decode().split()[0]
+    except FetchError:
+        md5 = None
+
+    for attempt in range(1, retries + 1):
+        try:
+            return download_file(url, os.path.join(out_dir, name), md5)
+        except (requests.RequestException, IOError) as e:
+            ### 4xx other than 429 is not retried, as in fetch_url
+            status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+            if attempt == retries or (status is not None and status < 500 and status != 429):
+                raise
+            log(f"Failed: {name} ({e!r}) ... retrying {attempt}")
+            time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+
+
+def download_ssh_data(out_dir=SSH_DIR, connections=SSH_CONNECTIONS, files=None, base_url=SSH_URL):
+    ### Fetch only granules missing from the manifest, several connections at once
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_file = os.path.join(out_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    files = list_ssh_granules() if files is None else files
+    todo = [x for x in files if not (x in manifest and os.path.exists(os.path.join(out_dir, x))
+                                     and os.path.getsize(os.path.join(out_dir, x)) == manifest[x]['size'])]
+    log(f"SSH: {len(files) - len(todo)} of {len(files)} granules already downloaded")
+
+    failed = {}
+    progress = Progress('SSH download', len(todo))
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        futures = {pool.submit(download_granule, x, out_dir, base_url): x for x in todo}
+        for fut in as_completed(futures):
+            file_ = futures[fut]
+            try:
+                manifest[file_] = fut.result()
+            except Exception as e:
+                failed[file_] = repr(e)
+                log(f"Failed: {file_} ... {e!r}")
+                progress.update()
+                continue
+            write_atomic(manifest_file, json.dumps(manifest, indent=1, sort_keys=True).encode())
+            progress.update(nbytes=manifest[file_]['size'])
+
+    return failed
         
         
 #%%
-def get_ssh(file_, north_region, south_region, east_region, west_region):
-    print(file_)
-    ds = xr.open_dataset(file_)
-    df = ds.to_dataframe().reset_index()
-
-    df = df[['Time', 'Latitude', 'Longitude', 'SLA', 'SLA_ERR']]
-    df = df.rename(columns={'Time': 'date', 'Latitude': 'lat', 'Longitude': 'lon', 'SLA': 'sla', 'SLA_ERR': 'sla_err'})
-
-    ### Rework -360 longitude
-    df.loc[:, 'lon'] = np.where(df['lon'] > 180, -360 + df['lon'], df['lon'])
-    df = df.dropna()
-
-    year = pd.to_datetime(df.date).dt.year
-    month = pd.to_datetime(df.date).dt.month
-    day = pd.to_datetime(df.date).dt.day
-
-    ### Subset Northern Region
-    ndf = df[(df['lat'] >= north_region[1]) & (df['lat'] <= north_region[3])]
-    ndf = ndf[(ndf['lon'] >= north_region[0]) & (ndf['lon'] <= north_region[2])]
-    ndf = ndf.assign(region = "North", year = year, month=month, day=day)    
-
-    ### Subset Southern Region
-    sdf = df[(df['lat'] >= south_region[1]) & (df['lat'] <= south_region[3])]
-    sdf = sdf[(sdf['lon'] >= south_region[0]) & (sdf['lon'] <= south_region[2])]
-    sdf = sdf.assign(region = "South", year = year, month=month, day=day)   
-
-    ### Subset Eastern Region
-    edf = df[(df['lat'] >= east_region[1]) & (df['lat'] <= east_region[3])]
-    edf = edf[(edf['lon'] >= east_region[0]) & (edf['lon'] <= east_region[2])]
-    edf = edf.assign(region = "East", year = year, month=month, day=day)   
-
-    ### Subset Western Region
-    wdf = df[(df['lat'] >= west_region[1]) & (df['lat'] <= west_region[3])]
-    wdf = wdf[(wdf['lon'] >= west_region[0]) & (wdf['lon'] <= west_region[2])]
-    wdf = wdf.assign(region = "West", year = year, month=month, day=day)   
-
-    ### Bind Regions
-    outdat = pd.concat([ndf, sdf, edf, wdf]).reset_index(drop=True)
-    outdat = outdat.assign(date = outdat['date'].dt.normalize())
-    outdat = outdat.drop_duplicates()
-    return outdat
+def get_ssh(file_, regions=REGIONS):
+    ### Compact arrays: every region's cells read once (through the subset cache), one date decode per file, float32 values
+    with xr.open_dataset(file_) as ds:
+        lats, lons = ds['Latitude'].values, ds['Longitude'].values
+        index = region_index(lats, lons, regions)
+        keys, sub = gather_cells(ds, ['SLA', 'SLA_ERR'], index, 'Latitude', 'Longitude')
+        lon_first = ds['SLA'].dims.index('Longitude') < ds['SLA'].dims.index('Latitude')
+        dates = ds['Time'].values.astype('datetime64[D]')
+
+    sla = sub['SLA'].transpose('Time', 'cell').values.astype('float32')
+    sla_err = sub['SLA_ERR'].transpose('Time', 'cell').values.astype('float32')
+    lons = np.where(lons > 180, -360 + lons, lons)
+
+    ### Calendar fields from the (usually single) file timestamp, not per row
+    days, day_id = np.unique(dates, return_inverse=True)
+    year = days.astype('datetime64[Y]').astype(int) + 1970
+    month = days.astype('datetime64[M]').astype(int) % 12 + 1
+    day = (days - days.astype('datetime64[M]')).astype(int) + 1
+
+    outdat = []
+    for region, (ilat, ilon, weight) in index.items():
+        ### Rows in the variable's own dimension order, as extract_regions gives them
+        order = np.lexsort((ilat, ilon)) if lon_first else np.arange(len(ilat))
+        ilat, ilon, weight = ilat[order], ilon[order], weight[order]
+        pos = np.searchsorted(keys, ilat * len(lons) + ilon)
+        a = sla[:, pos].ravel()
+        b = sla_err[:, pos].ravel()
+        t = day_id.repeat(len(ilat))
+        cell = np.tile(np.arange(len(ilat)), len(dates))
+
+        ### Drop missing cells, then duplicate rows on integer keys: (day, lat, lon) and the values' bits, so
+        ### same-day timestamps with different values are kept as the full-row drop_duplicates kept them
+        ok = np.flatnonzero(~(np.isnan(a) | np.isnan(b)))
+        key = (t[ok] * len(lats) + ilat[cell[ok]]) * len(lons) + ilon[cell[ok]]
+        bits = [(x[ok] + np.float32(0)).view('uint32').astype('int64') for x in (a, b)]
+        bits = (bits[0] << 32) | bits[1]
+        ok = ok[np.sort(np.unique(np.stack([key, bits], axis=1), axis=0, return_index=True)[1])]
+        t, cell = t[ok], cell[ok]
+
+        outdat.append(pd.DataFrame({'date': days[t].astype('datetime64[ns]'), 'lat': lats[ilat[cell]], 'lon': lons[ilon[cell]],
+                                    'sla': a[ok], 'sla_err': b[ok], 'weight': weight[cell], 'region': region,
+                                    'year': year[t].astype('int32'), 'month': month[t].astype('int32'), 'day': day[t].astype('int32')}))
+    return pd.concat(outdat).reset_index(drop=True)
 
 
 #%%
-def proc_cc(start_date, end_date, cc_int, n_region):
-    # start_date = ccdat.sdate[0]
-    # end_date = ccdat.edate[0]
-    # cc_int = ccdat.intensity[0]
-    # n_region = ccdat.region[2]
-
-    outdat = pd.DataFrame()
-    for region_ in n_region.split(','):
-        region_ = region_.strip()
-        indat = pd.DataFrame({'date': pd.DatetimeIndex(pd.date_range(start_date, end_date, freq='M').strftime("%Y-%m"))})    
-        indat = indat.assign(year = indat.date.dt.year,
-                             month = indat.date.dt.month,
-                             region = region_,
-                             intensity = cc_int)
-        indat = indat[indat['year'] >= 2010]
-        indat = indat.assign(timeSeries = range(1, 1 + len(indat)))
-        outdat = pd.concat([outdat, indat])
+def expand_cc(ccdat, min_year=2010):
+    ### One row per (event, region), regions split from the comma-separated list
+    events = ccdat[['sdate', 'edate', 'region', 'intensity']].reset_index(drop=True)
+    events = events.assign(region = events['region'].str.split(',')).explode('region')
+    events = events.assign(region = events['region'].str.strip()).reset_index(drop=True)
+
+    ### Months whose month-end (at the start's time of day, as pd.date_range does) falls in [sdate, edate]
+    sdate = pd.to_datetime(events['sdate'])
+    edate = pd.to_datetime(events['edate'])
+    first = sdate.dt.year * 12 + sdate.dt.month - 1
+    last = edate.dt.year * 12 + edate.dt.month - 1
+    last_end = edate.dt.normalize() + pd.offsets.MonthEnd(0) + (sdate - sdate.dt.normalize())
+    last = last - (last_end > edate)
+    nmonths = np.clip(last - first + 1, 0, None).to_numpy()
+
+    ### Arithmetic month offsets instead of a date_range per event
+    row = np.repeat(np.arange(len(events)), nmonths)
+    offset = np.arange(len(row)) - np.repeat(np.cumsum(nmonths) - nmonths, nmonths)
+    months = first.to_numpy()[row] + offset
+    year = months // 12
+    month = months % 12 + 1
+    keep = year >= min_year
+    row, offset, year, month = row[keep], offset[keep], year[keep], month[keep]
+
+    outdat = pd.DataFrame({'date': pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1})).to_numpy(),
+                           'year': year.astype('int32'),
+                           'month': month.astype('int32'),
+                           'region': events['region'].to_numpy()[row],
+                           'intensity': events['intensity'].to_numpy()[row]},
+                          index=offset)
+
+    ### Running month count within each event-region
+    outdat = outdat.assign(timeSeries = pd.Series(row).groupby(row).cumcount().to_numpy() + 1)
     return outdat
 
 
-   
-    
 #%%
-if __name__ == "__main__":
-    # ### Dask setup    
-    # NCORES = multiprocessing.cpu_count() - 1
-    # NCORES = 30
-    # client = Client(n_workers=NCORES, threads_per_worker=1)
-
-    # ### Puerto Rico Regions
-    # North = [-67.6538, 18.491170, -65.4236, 19.491170]
-    # West = [-68.1034, 17.7236, -67.1034, 18.74117]
-    # South = [-67.6538, 17.0288, -65.4236, 18.0288]
-    # East = [-65.929,  17.7236, -64.929, 18.74117]
-
-    # # ### Get SST
-    # sst_dat = proc_sst()    
-    # sst_dat.to_csv('./data/PR_SST_daily_regional_2010-2019.csv', index=False)
-
-
-    # ### Get CHL
-    # files = sorted(glob.glob('/data2/CHL/NC/DAILY/*.nc'))
-    # results = compute([delayed(get_chl)(file_, North, South, East, West) for file_ in files])
-    # chl_dat = pd.concat([d for d in results[0][:]])
-    # chl_dat = chl_dat.reset_index(drop=True)
-    # chl_dat.to_csv('data/PR_CHL_daily_regional_2010_2019.csv', index=False)
-
-
-
-    # ### Get Wind data
-    # # Build data frame to loop through
-    # nbuoys = ["sjnp4", "arop4", "41053"]
-    # sbuoys = ["mgip4", "42085"]
-    # wbuoys = ["ptrp4", "41115", "mgzp4"]
-    # ebuoys = ["41056", "41052", "clbp4", "espp4"]
-    # nlst_ = [(x, y, "North") for x in nbuoys for y in range(2010, 2019)]
-    # slst_ = [(x, y, "South") for x in sbuoys for y in range(2010, 2019)]
-    # wlst_ = [(x, y, "West") for x in wbuoys for y in range(2010, 2019)]
-    # elst_ = [(x, y, "East") for x in ebuoys for y in range(2010, 2019)]
-
-
+def aggregate_cc(ccdat2, threshold=-1, keys=['year', 'month', 'region']):
+    ### Conflict (intensity <= threshold) vs cooperation, count/sum/mean in one grouped pass
+    ccdat2 = ccdat2.assign(group_1 = np.where(ccdat2['intensity'] <= threshold, 0, 1))
+    stats = ccdat2.groupby(keys + ['group_1'])['intensity'].agg(['size', 'sum', 'mean'])
+    dtypes = stats.dtypes
+    stats = stats.assign(mean = stats['mean'].abs()).unstack('group_1')
+
+    ccdat3 = pd.DataFrame(index=stats.index)
+    for group, name in [(0, 'conflict'), (1, 'coop')]:
+        for stat, label in [('size', 'count'), ('sum', 'sum'), ('mean', 'mean')]:
+            ccdat3[f'{name}_{label}'] = stats[(stat, group)] if (stat, group) in stats.columns else np.nan
+
+    ### Keep months with conflict, as the conflict-first left merges did
+    ccdat3 = ccdat3[ccdat3['conflict_count'].notna()]
+    for name in ['conflict', 'coop']:
+        for stat, label in [('size', 'count'), ('sum', 'sum')]:
+            if ccdat3[f'{name}_{label}'].notna().all():
+                ccdat3[f'{name}_{label}'] = ccdat3[f'{name}_{label}'].astype(dtypes[stat])
 
-    # ### Build list to compress
-    # lst_ = nlst_ + slst_ + wlst_ + elst_
-    # results = compute([delayed(get_wind)(g) for g in lst_])
-    # wind_dat = pd.concat([d for d in results[0][:]]).reset_index(drop=True)
-    # wind_dat.to_csv('data/PR_Wind_daily_regional_2010-2019', index=False)
-
-
-    # ### Hurricane data
-    # # August 2014; August 2015; Sept 2017; July 2018; August 2019; Sept 2019
-    # hurr_events = ['2014-08', '2015-08', '2017-09', '2018-07', '2019-08', '2019-09']
-    # dates = [i.strftime("%Y-%m") for i in pd.date_range(start="2010-01-01", end="2019-12-01", freq='MS')]
-    # hurr_dat = pd.DataFrame({'date': dates, "hurricane": 0})
-    # hurr_dat = hurr_dat.assign(hurricane = np.where(hurr_dat['date'].isin(hurr_events), 1, 0))
-    # hurr_dat.to_csv('data/PR_Hurricane_daily_regional_2010-2019', index=False)
-    
+    # Get ratios    
+    ccdat3 = ccdat3.assign(cc_ratio_count = ccdat3['conflict_count'] / ccdat3['coop_count'],
+                           cc_ratio_sum = ccdat3['conflict_sum'] / ccdat3['coop_sum'],
+                           cc_ratio_mean = ccdat3['conflict_mean'] / ccdat3['coop_mean'])
+    return ccdat3.reset_index()
 
 
-    # ### Get Sea Surface Height
-    # # Download PODACC files
-    # # download_ssh_data()
-    
-    # # Get files from download
-    # files = glob.glob('/data2/SSH/PODACC/*.nc')
-    
-    # ### Build list to compress
-    # # results = [get_ssh(file_, North, South, East, West) for file_ in files]
-    # results = compute([delayed(get_ssh)(file_, North, South, East, West) for file_ in files])
-    # ssh_dat = pd.concat([d for d in results[0][:]]).reset_index(drop=True)
-    # ssh_dat.to_csv('data/PR_SSH_5day_regional_2010-2019', index=False)
+#%%
+def encode_keys(df, on, regions, year0):
+    ### Mixed-radix integer key over the given subset of (year, month, region); -1 marks unknown regions
+    key = np.zeros(len(df), dtype='int64')
+    if 'year' in on:
+        key = df['year'].to_numpy().astype('int64') - year0
+    if 'month' in on:
+        key = key * 12 + df['month'].to_numpy().astype('int64') - 1
+    if 'region' in on:
+        code = pd.Index(regions).get_indexer(df['region'])
+        key = np.where(code >= 0, key * len(regions) + code, -1)
+    return key
+
+
+def index_covariates(tables, regions, year0):
+    ### Pre-index each covariate table once on its encoded key
+    indexed = []
+    for table, on in tables:
+        key = encode_keys(table, on, regions, year0)
+        keep = (key >= 0) if 'region' in on else np.ones(len(key), dtype=bool)
+        index = pd.Index(key[keep])
+        if index.has_duplicates:
+            raise ValueError(f"Covariate table with columns {list(table.columns)} is not unique on {on}")
+        indexed.append((on, index, table.drop(columns=on)[keep].reset_index(drop=True)))
+    return indexed
+
+
+def gather_covariates(base, indexed, regions, year0):
+    ### One aligned gather per table; missing keys become NaN like a left merge
+    block = []
+    for on, index, values in indexed:
+        pos = index.get_indexer(encode_keys(base, on, regions, year0))
+        block.append(values.reindex(pos).reset_index(drop=True))
+    return pd.concat(block, axis=1)
+
+
+def assemble_panels(efdat3, ccdat3, events, covariates, keys=['year', 'month', 'region']):
+    ### Aggregated (regdat) and event-level (mregdat) panels from one covariate block
+    efdat3 = efdat3.reset_index(drop=True)
+    regions = sorted(efdat3['region'].dropna().unique())
+    year0 = int(efdat3['year'].min())
+
+    ### Covariates gathered once at the effort rows, shared by both panels
+    block = gather_covariates(efdat3, index_covariates(covariates, regions, year0), regions, year0)
+    cc = gather_covariates(efdat3, index_covariates([(ccdat3, keys)], regions, year0), regions, year0)
+    regdat = pd.concat([efdat3, cc, block], axis=1)
+
+    ### Event-level rows: one integer-key join, then positional takes of effort and covariates
+    rows = pd.DataFrame({'_key': encode_keys(efdat3, keys, regions, year0), '_row': np.arange(len(efdat3))})
+    events = events.drop(columns=keys).assign(_key = encode_keys(events, keys, regions, year0))
+    rows = rows.merge(events, on='_key', how='left')
+    mregdat = pd.concat([efdat3.take(rows['_row']).reset_index(drop=True),
+                         rows.drop(columns=['_key', '_row']),
+                         block.take(rows['_row']).reset_index(drop=True)], axis=1)
+
+    for panel in [regdat, mregdat]:
+        if panel.columns.has_duplicates:
+            raise ValueError(f"Duplicate panel columns: {list(panel.columns[panel.columns.duplicated()])}")
+    return regdat, mregdat
 
 
+#%%
+def partition_path(file_, out_dir, fmt=None):
+    ### fmt=None follows FILE_FORMAT at call time, not at definition time
+    fmt = FILE_FORMAT if fmt is None else fmt
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(file_))[0] + f'.{fmt}')
+
+
+def write_frame(df, path):
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def read_frame(path, columns=None):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def source_stamp(file_, task=None):
+    stat = os.stat(file_)
+    return {'source': os.path.abspath(file_), 'mtime': stat.st_mtime, 'size': stat.st_size, 'task': task}
+
+
+### Module settings that change how a stage or partition runs but not what it returns, left out of code digests
+RUNTIME_SETTINGS = {'REPORT', 'NCORES', 'NDBC_WORKERS', 'SSH_CONNECTIONS', 'CHUNK_TARGET', 'PROGRESS_EVERY', 'PROFILER',
+                    'REPORT_DIR', 'STAGE_CACHE', 'REGION_CACHE', 'NDBC_CACHE', 'LANDINGS_CACHE', 'SUBSET_CACHE',
+                    'SUBSET_CACHE_MB', 'SUBSET_MEMORY_MB'}
+
+
+def class_functions(cls):
+    ### Plain, static and class methods of a class, by name
+    funcs = {k: getattr(v, '__func__', v) for k, v in vars(cls).items()}
+    return {k: v for k, v in sorted(funcs.items()) if inspect.isfunction(v)}
+
+
+def code_fingerprint(code):
+    ### Bytecode, names and constants of a code object and the code nested in it
+    consts = [code_fingerprint(x) if inspect.iscode(x) else repr(x) for x in code.co_consts]
+    return hashlib.sha256(code.co_code + repr((code.co_names, consts)).encode()).hexdigest()
+
+
+def code_source(obj):
+    ### Source of a function, or of each method of a class; where there is none (a class or function defined in
+    ### a cell of an interactive window) the bytecode and default values stand in for it
+    if inspect.isclass(obj):
+        attrs = {k: v for k, v in vars(obj).items() if isinstance(v, (str, int, float, bool, list, tuple, dict, set, frozenset))}
+        return repr(sorted(attrs.items())) + ''.join(f"{k}:{code_source(v)}" for k, v in class_functions(obj).items())
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return code_fingerprint(obj.__code__) + repr((obj.__defaults__, obj.__kwdefaults__))
+
+
+def global_names(obj):
+    ### Global names read by a function (nested code included) or a class's methods, and those in default arguments
+    if inspect.isclass(obj):
+        return set().union(*[global_names(x) for x in class_functions(obj).values()])
+    names = set()
+    todo = [obj.__code__]
+    while todo:
+        code = todo.pop()
+        names |= {x.argval for x in dis.get_instructions(code) if x.opname in ('LOAD_GLOBAL', 'LOAD_NAME')}
+        todo += [x for x in code.co_consts if inspect.iscode(x)]
+    try:
+        node = ast.parse(textwrap.dedent(inspect.getsource(obj))).body[0]
+    except (OSError, TypeError):
+        ### No source: the default values themselves are part of code_source
+        return names
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        defaults = node.args.defaults + [x for x in node.args.kw_defaults if x is not None]
+        names |= {x.id for d in defaults for x in ast.walk(d) if isinstance(x, ast.Name)}
+    return names
+
+
+def code_closure(funcs):
+    ### Module functions and classes reachable from funcs through the globals they read, and the
+    ### plain-data module settings they read, so helpers and switches need no hand-kept list
+    code, settings = {}, {}
+    todo = [x.func if isinstance(x, partial) else x for x in funcs]
+    while todo:
+        obj = todo.pop()
+        if obj.__qualname__ in code:
+            continue
+        code[obj.__qualname__] = obj
+        scope = vars(sys.modules[obj.__module__]) if inspect.isclass(obj) else obj.__globals__
+        for name in global_names(obj):
+            if name not in scope or name.startswith('_') or name in RUNTIME_SETTINGS:
+                continue
+            value = scope[name]
+            if (inspect.isfunction(value) or inspect.isclass(value)) and value.__module__ == obj.__module__:
+                todo.append(value)
+            elif isinstance(value, (str, int, float, bool, list, tuple, dict, type(None))):
+                settings[name] = value
+    return code, settings
+
+
+def code_digest(funcs):
+    ### Sources of everything funcs reach plus the settings they read
+    code, settings = code_closure(funcs)
+    digest = hashlib.sha256()
+    for x in sorted(code):
+        digest.update(code_source(code[x]).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+
+def describe_task(func):
+    ### Function names, code digests and bound arguments of a (nested) partial, in a JSON-able form
+    if isinstance(func, partial):
+        return {'func': describe_task(func.func), 'args': [describe_task(x) for x in func.args],
+                'keywords': {k: describe_task(v) for k, v in sorted(func.keywords.items())}}
+    if inspect.isfunction(func):
+        return [func.__qualname__, code_digest([func])]
+    if callable(func) and hasattr(func, '__qualname__'):
+        return func.__qualname__
+    return func
+
+
+def task_digest(func):
+    ### What a partition was computed with: the same file under another function, code (with the helpers
+    ### and settings it reaches) or regions is not done
+    return hashlib.sha1(json.dumps(describe_task(func), sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def partition_done(file_, part, task=None):
+    ### Partition counts as done only if its stamp matches the current source file and task
+    if not (os.path.exists(part) and os.path.exists(part + '.json')):
+        return False
+    with open(part + '.json') as f:
+        return json.load(f) == source_stamp(file_, task)
+
+
+def write_partition(func, file_, part, task=None):
+    ### Returns the file's instrumentation record
+    df, record = probed(func, file_)
+
+    ### Write to temp file then rename, stamp last so partial writes are never reused
+    tmp = part + '.tmp' + os.path.splitext(part)[1]
+    write_frame(df, tmp)
+    os.replace(tmp, part)
+    with open(part + '.json', 'w') as f:
+        json.dump(source_stamp(file_, task), f)
+    return record
+
+
+def run_partitioned(func, files, out_dir, ncores=NCORES, max_in_flight=None):
+    ### Run func on each file in a process pool, one partition per file, skipping finished ones
+    os.makedirs(out_dir, exist_ok=True)
+    max_in_flight = max_in_flight or 2 * ncores
+    task = task_digest(func)
+    parts = {file_: partition_path(file_, out_dir) for file_ in files}
+    todo = [file_ for file_ in files if not partition_done(file_, parts[file_], task)]
+    log(f"{out_dir}: {len(files) - len(todo)} of {len(files)} partitions already done")
+
+    failed = {}
+    pending = {}
+    progress = Progress(out_dir, len(todo))
+
+    def collect():
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in finished:
+            file_ = pending.pop(fut)
+            if fut.exception() is not None:
+                failed[file_] = fut.exception()
+                log(f"Failed: {file_} ... {fut.exception()!r}")
+                progress.update()
+                continue
+            record = fut.result()
+            if REPORT is not None:
+                REPORT.add_file(record)
+            progress.update(nbytes=record['file_bytes'])
+
+    with ProcessPoolExecutor(max_workers=ncores) as pool:
+        for file_ in todo:
+            ### Bounded in-flight tasks
+            while len(pending) >= max_in_flight:
+                collect()
+            pending[pool.submit(write_partition, func, file_, parts[file_], task)] = file_
+        while pending:
+            collect()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(todo)} files failed in {out_dir}: {sorted(failed)}")
+    return [parts[file_] for file_ in files]
+
+
+def combine_partitions(parts, variable):
+    ### Append partitions one at a time so memory stays at one partition
+    for i, part in enumerate(parts):
+        save_daily(read_frame(part), variable, append=(i > 0),
+                   name=os.path.splitext(os.path.basename(part))[0])
+    return variable
 
-    # Get area of region
-    North = [-67.6538, 18.491170, -65.4236, 19.491170]
-    West = [-68.1034, 17.7236, -67.1034, 18.74117]
-    South = [-67.6538, 17.0288, -65.4236, 18.0288]
-    East = [-65.929,  17.7236, -64.929, 18.74117]
 
-    area_df = pd.DataFrame({'region': ["North", "West", "South", "East"],
-                            'area': [(North[2] - North[0]) * (North[3] - North[1]),
-                                    (West[2] - West[0]) * (West[3] - West[1]),
-                                    (South[2] - South[0]) * (South[3] - South[1]),
-                                    (East[2] - East[0]) * (East[3] - East[1])]})
+#%%
+def write_columnar(df, variable, values, name, root=COLUMNAR_ROOT):
+    ### Typed columns: float32 values, categorical region, native timestamps, int year/month
+    if 'date' in df.columns:
+        df = df.assign(date = pd.to_datetime(df['date']))
+    if 'year' not in df.columns:
+        df = df.assign(year = df['date'].dt.year, month = df['date'].dt.month)
+
+    df = df.assign(**{x: pd.to_numeric(df[x], errors='coerce').astype('float32') for x in values})
+    df = df.assign(year = df['year'].astype('int16'),
+                   month = df['month'].astype('int8'),
+                   region = df['region'].astype('category'))
+
+    ### One file per source name inside variable=/year=/region= partitions
+    df.to_parquet(os.path.join(root, f'variable={variable}'), index=False,
+                  partition_cols=['year', 'region'],
+                  basename_template=f'{name}-{{i}}.parquet',
+                  existing_data_behavior='overwrite_or_ignore')
+
+
+def save_daily(df, variable, append=False, name=None, fmt=None):
+    fmt = FILE_FORMAT if fmt is None else fmt
+    csv_path, values = DAILY[variable]
+    if fmt == 'parquet':
+        if not append:
+            shutil.rmtree(os.path.join(COLUMNAR_ROOT, f'variable={variable}'), ignore_errors=True)
+        write_columnar(df, variable, values, name or variable)
+    else:
+        df.to_csv(csv_path, mode='a' if append else 'w', header=not append, index=False)
+
+
+def daily_files(variable, fmt=None):
+    ### Files read_daily reads, for stage stamps
+    fmt = FILE_FORMAT if fmt is None else fmt
+    if fmt == 'parquet':
+        return sorted(glob.glob(os.path.join(COLUMNAR_ROOT, f'variable={variable}', '**', '*.parquet'), recursive=True))
+    return [x for x in DAILY[variable][:1] if os.path.exists(x)]
+
+
+def read_daily(variable, min_year=None, max_year=None, regions=None, weight=False, fmt=None):
+    ### Returns year, month, region and the value columns (and the cell area weight)
+    fmt = FILE_FORMAT if fmt is None else fmt
+    csv_path, values = DAILY[variable]
+    values = values + ['weight'] if weight else values
+    if fmt == 'parquet':
+        ### Column and partition pruning
+        filters = []
+        if min_year is not None:
+            filters.append(('year', '>=', min_year))
+        if max_year is not None:
+            filters.append(('year', '<=', max_year))
+        if regions is not None:
+            filters.append(('region', 'in', list(regions)))
+        df = pd.read_parquet(os.path.join(COLUMNAR_ROOT, f'variable={variable}'),
+                             columns=['year', 'month', 'region'] + values,
+                             filters=filters or None)
+        return df.assign(year = df['year'].astype(int), region = df['region'].astype(str))
+
+    df = pd.read_csv(csv_path, index_col=False)
+    if 'year' not in df.columns:
+        date = pd.to_datetime(df['date'])
+        df = df.assign(year = date.dt.year, month = date.dt.month)
+    df = df[['year', 'month', 'region'] + values]
+    if min_year is not None:
+        df = df[df['year'] >= min_year]
+    if max_year is not None:
+        df = df[df['year'] <= max_year]
+    if regions is not None:
+        df = df[df['region'].isin(regions)]
+    return df
 
 
+#%%
+def moments(df, keys, values, weight=None):
+    ### Per-group count, weight sum, weighted mean and weighted M2 for each value column (unit weights by default)
+    grouped = df.groupby(keys)
+    group = grouped.ngroup().to_numpy()
+    index = grouped.size().index
+    valid = group >= 0
+    group = group[valid]
+    w = df[weight].to_numpy('float64')[valid] if weight else np.ones(len(group))
+
+    outdat = {}
+    for x in values:
+        v = df[x].to_numpy('float64')[valid]
+        ok = ~np.isnan(v)
+        wx = np.where(ok, w, 0)
+        v = np.where(ok, v, 0)
+        sw = np.bincount(group, weights=wx, minlength=len(index))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.bincount(group, weights=wx * v, minlength=len(index)) / sw
+        mean = np.where(sw > 0, mean, np.nan)
+        outdat[f'{x}_n'] = np.bincount(group, weights=ok, minlength=len(index)).astype(int)
+        outdat[f'{x}_w'] = sw
+        outdat[f'{x}_mean'] = mean
+        outdat[f'{x}_m2'] = np.bincount(group, weights=wx * (v - np.nan_to_num(mean[group])) ** 2, minlength=len(index))
+    return pd.DataFrame(outdat, index=index)
+
+
+def merge_moments(a, b, values):
+    ### Combine two moment tables (Chan et al. parallel update on the weight sums), outer-aligned on the group keys
+    a, b = a.align(b, join='outer', fill_value=0)
+    outdat = {}
+    for x in values:
+        wa, wb = a[f'{x}_w'], b[f'{x}_w']
+        w = wa + wb
+        ### A side with no valid values (w == 0, mean NaN) contributes nothing
+        a_mean, b_mean = a[f'{x}_mean'].fillna(0), b[f'{x}_mean'].fillna(0)
+        delta = b_mean - a_mean
+        outdat[f'{x}_n'] = a[f'{x}_n'] + b[f'{x}_n']
+        outdat[f'{x}_w'] = w
+        outdat[f'{x}_mean'] = (a_mean + delta * wb / w).where(w > 0)
+        outdat[f'{x}_m2'] = a[f'{x}_m2'] + b[f'{x}_m2'] + (delta ** 2 * wa * wb / w).where(w > 0, 0)
+    return pd.DataFrame(outdat)
+
+
+def finalize_moments(state, values):
+    ### Mean and sample variance (ddof=1, same as pandas var when unweighted)
+    outdat = {}
+    for x in values:
+        n = state[f'{x}_n']
+        outdat[f'{x}_mean'] = state[f'{x}_mean']
+        outdat[f'{x}_var'] = (state[f'{x}_m2'] / state[f'{x}_w'] * n / (n - 1)).where(n > 1)
+    return pd.DataFrame(outdat).reset_index()
+
+
+def file_moments(file_, extract, values, keys=['year', 'month', 'region'], weight=None):
+    ### Extract one file and reduce it to monthly moments right away
+    df = extract(file_)
+    if 'date' in df.columns:
+        date = pd.to_datetime(df['date'])
+        df = df.assign(year = date.dt.year, month = date.dt.month)
+    df = df.assign(year = df['year'].astype(int), month = df['month'].astype(int))
+    return moments(df, keys, values, weight).reset_index()
+
+
+def fold_moments(parts, values, keys=['year', 'month', 'region']):
+    ### Running state is O(regions x months), partitions are read one at a time
+    state = None
+    for part in parts:
+        m = read_frame(part).set_index(keys)
+        state = m if state is None else merge_moments(state, m, values)
+    return state
+
+
+def proc_monthly(variable, extract, values, ncores=NCORES, weight=None, tag=''):
+    ### Per-file monthly moments on the scheduler, then fold into monthly mean/var
+    ### (tag separates partitions built for different regions/weighting)
+    parts = run_partitioned(partial(file_moments, extract=extract, values=values, weight=weight),
+                            archive_files(variable), os.path.join('data/partitions', f'{variable}_monthly', tag), ncores=ncores)
+    return finalize_moments(fold_moments(parts, values), values)
+
+
+def collapse_moments(df, keys, values):
+    ### Combine many moment rows per group at once (same result as folding merge_moments)
+    outdat = {}
+    for x in values:
+        sw = df.groupby(keys)[f'{x}_w'].transform('sum')
+        mean = (df[f'{x}_mean'] * df[f'{x}_w'] / sw).fillna(0)
+        group_mean = mean.groupby([df[k] for k in keys]).transform('sum')
+        spread = (df[f'{x}_w'] * (df[f'{x}_mean'] - group_mean) ** 2).fillna(0)
+        stats = df.assign(_spread = spread, _mean = mean).groupby(keys)
+        outdat[f'{x}_n'] = stats[f'{x}_n'].sum()
+        outdat[f'{x}_w'] = stats[f'{x}_w'].sum()
+        outdat[f'{x}_mean'] = stats['_mean'].sum().where(outdat[f'{x}_w'] > 0)
+        outdat[f'{x}_m2'] = stats[f'{x}_m2'].sum() + stats['_spread'].sum()
+    return pd.DataFrame(outdat)
+
+
+def add_day(ds):
+    ### Time axis for one-file-per-day archives, from the year-day in the file name
+    day = pd.to_datetime(os.path.basename(ds.encoding['source']).split('.')[0][-7:], format="%Y%j")
+    return ds.expand_dims(time = [day])
+
+
+def open_archive(variable, regions, chunk_target=CHUNK_TARGET, ncores=NCORES):
+    ### Lazy multi-file dataset cut to the window covering every region, time-chunked to the chunk target
+    files = archive_files(variable)
+    variables, lat, lon, time_ = ARCHIVES[variable]
+    dim = time_ or 'time'
+    with xr.open_dataset(files[0]) as ds:
+        index = region_index(ds[lat].values, ds[lon].values, regions)
+    ilats = np.concatenate([x[0] for x in index.values()] + [[0]])
+    ilons = np.concatenate([x[1] for x in index.values()] + [[0]])
+    window = {lat: slice(ilats.min(), ilats.max() + 1), lon: slice(ilons.min(), ilons.max() + 1)}
+
+    def preprocess(ds):
+        ds = ds[variables].isel(window)
+        return ds if time_ else add_day(ds)
+
+    ds = xr.open_mfdataset(files, preprocess=preprocess, combine='nested', concat_dim=dim,
+                           chunks={}, data_vars='minimal', coords='minimal', compat='override')
+
+    ### Each worker holds one chunk plus float64 temporaries (~4x)
+    step = sum(ds[x].isel({dim: 0}).nbytes for x in variables)
+    chunk = max(1, int(dask.utils.parse_bytes(chunk_target) / (4 * ncores * max(step, 1))))
+    ds = ds.chunk({dim: chunk})
+
+    ### Region cell positions relative to the window
+    cells = {region: (ilat - window[lat].start, ilon - window[lon].start, weight) for region, (ilat, ilon, weight) in index.items()}
+    return ds, cells
+
+
+def archive_moments(variable, regions, weight=None, chunk_target=CHUNK_TARGET, ncores=NCORES):
+    ### Per-time-step region moments computed chunk by chunk, then collapsed to monthly moments
+    ds, cells = open_archive(variable, regions, chunk_target, ncores)
+    variables, lat, lon, time_ = ARCHIVES[variable]
+
+    steps = []
+    for region, (ilat, ilon, cell_weight) in cells.items():
+        sub = ds.isel({lat: xr.DataArray(ilat, dims='cell'), lon: xr.DataArray(ilon, dims='cell')})
+        w = xr.DataArray(cell_weight if weight else np.ones(len(ilat)), dims='cell')
+        stats = {}
+        for x in variables:
+            v = sub[x].astype('float64')
+            wx = w.where(v.notnull(), 0)
+            sw = wx.sum('cell')
+            mean = (wx * v).sum('cell') / sw
+            stats[f'{x.lower()}_n'] = v.notnull().sum('cell')
+            stats[f'{x.lower()}_w'] = sw
+            stats[f'{x.lower()}_mean'] = mean
+            stats[f'{x.lower()}_m2'] = (wx * (v - mean.fillna(0)) ** 2).sum('cell')
+        steps.append(xr.Dataset(stats).expand_dims(region = [region]))
+
+    ### Only the (region, time) reductions are materialized
+    with dask.config.set(scheduler='threads', num_workers=ncores):
+        steps = xr.concat(steps, dim='region').compute()
+
+    steps = steps.to_dataframe().reset_index()
+    date = pd.to_datetime(steps[time_ or 'time'])
+    steps = steps.assign(year = date.dt.year, month = date.dt.month)
+    return collapse_moments(steps, ['year', 'month', 'region'], [x.lower() for x in variables])
 
 
+#%%
+def region_areas(regions):
+    ### Spherical area in km2 (was a flat degree x degree product)
+    return pd.DataFrame({'region': list(regions),
+                         'area': [region_area(x) for x in regions.values()]})
+
+
+def env_monthly(variable, regions, start_year, weighted=AREA_WEIGHTED, out_of_core=OUT_OF_CORE):
+    ### Monthly gridded covariates, from the lazy archive, from per-file moments or from the daily regional tables
+    values = {'sst': ['sst'], 'chl': ['chlor_a'], 'ssh': ['sla', 'sla_err']}[variable]
+    extract = {'sst': get_sst, 'chl': get_chl, 'ssh': get_ssh}[variable]
+    weight = 'weight' if weighted else None
+    if out_of_core:
+        outdat = finalize_moments(archive_moments(variable, regions, weight), values)
+    elif STREAM_MONTHLY:
+        tag = hashlib.sha1(json.dumps([regions, weighted], sort_keys=True).encode()).hexdigest()[:12]
+        outdat = proc_monthly(variable, partial(extract, regions=regions), values, weight=weight, tag=tag)
+    else:
+        daily = read_daily(variable, min_year=start_year, regions=list(regions), weight=weighted)
+        outdat = finalize_moments(moments(daily, ['year', 'month', 'region'], values, weight), values)
 
+    # SSH
+    if variable == 'ssh':
+        outdat = outdat[outdat['year'] >= start_year][['year', 'month', 'region', 'sla_mean', 'sla_err_mean']]
+        outdat.columns = ['year', 'month', 'region', 'sla', 'sla_err']
+    return outdat
 
-    # -------------------------------------------------------------------------
-    # Monthly estimates
 
-    # Merge data into panel set
-    sst = pd.read_csv('data/PR_SST_daily_regional_2010-2019.csv', index_col=False)
-    chl = pd.read_csv('data/PR_CHL_daily_regional_2010_2019.csv', index_col=False)
-    wind = pd.read_csv('data/PR_Wind_daily_regional_2010-2019', index_col=False)
-    # hurr = pd.read_csv('data/PR_Hurricane_daily_regional_2010-2019', index_col=False)
-    hurr = pd.read_csv('data/hurricanes_138km.csv', index_col=False)
-    noi = pd.read_csv('data/NOI_Index.csv')
-    ssh = pd.read_csv('data/PR_SSH_5day_regional_2010-2019', index_col=False)
+def wind_monthly(tasks, start_year=None, regions=None, base_url=NDBC_URL, cache_dir=NDBC_CACHE):
+    wind_dat, wind_failures = fetch_wind(tasks, base_url=base_url, cache_dir=cache_dir)
+    wind_failures.to_csv(WIND_FAILURES, index=False)
+    if len(wind_dat) == 0:
+        raise RuntimeError(f"No wind data: all {len(tasks)} buoy-years failed ({WIND_FAILURES})\n"
+                           + wind_failures.to_string(index=False))
+    save_daily(wind_dat, 'wind')
 
-    # SST
-    sst = sst.assign(month=pd.to_datetime(sst['date']).dt.month, year=pd.to_datetime(sst['date']).dt.year)
-    sst = sst.groupby(['year', 'month', 'region']).agg({'sst': ['mean', 'var']}).reset_index()
-    sst.columns = ['year', 'month', 'region', 'sst_mean', 'sst_var']
+    wind = read_daily('wind', min_year=start_year, regions=None if regions is None else list(regions))
+    return wind.groupby(['year', 'month', 'region']).agg({'WSPD': 'mean'}).reset_index()
 
-    # CHL
-    chl = chl.groupby(['year', 'month', 'region']).agg({'chlor_a': ['mean', 'var']}).reset_index()
-    chl.columns = ['year', 'month', 'region', 'chlor_a_mean', 'chlor_a_var']
 
-    # Wind
-    wind = wind.assign(month=pd.to_datetime(wind['date']).dt.month, year=pd.to_datetime(wind['date']).dt.year)
-    wind = wind.groupby(['year', 'month', 'region']).agg({'WSPD': 'mean'}).reset_index()
+def wind_complete(wind):
+    ### Only missing buoy-years (404) failed, so the stage can be cached; transient errors are retried next run
+    failures = pd.read_csv(WIND_FAILURES)
+    return bool(failures['error'].astype(str).str.startswith('HTTP 404').all())
 
-    # Hurricane
-    # hurr = hurr.assign(month=pd.to_datetime(hurr['date']).dt.month, year=pd.to_datetime(hurr['date']).dt.year)
-    # hurr['hurricane'] = np.where(hurr['hurricane'] >= 1, 1, 0)
-    
-    # SSH
-    ssh = ssh[ssh['year'] >= 2010].groupby(['year', 'month', 'region']).agg({'sla': 'mean', 'sla_err': 'mean'}).reset_index()
 
-    # ------------------------------------------------
-    # Monthly Puerto Rico Data    
-    efdat = pd.read_csv('data/PR_nonconf_landings_2010_19_2021-01-07.CSV')
-    cdat = pd.read_csv('./data/Municipalities_by_region_Puerto_Rico_wideFormat.csv')
-    ccdat = pd.read_csv('data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv')
-    # ccdat = pd.read_csv('data/FCCE_Master_Intensity_Expanded.csv')
-    pricedat = pd.read_csv('data/PR_Fish_Species_Prices_2010_2018.csv')
+def load_cc(path, start_year):
+    ccdat = pd.read_csv(path)
 
     # [1] Clean Intensity data (dependent variables)
-    # Index(['YEAR_LANDED', 'MONTH_LANDED', 'LANDING_LOCATION_COUNTY',
-    #    'SPECIES_ITIS', 'ITIS_COMMON_NAME', 'ITIS_SCIENTIFIC_NAME',
-    #    'POUNDS_LANDED', 'ADJUSTED_POUNDS', 'trips', 'fishers'],
-    #   dtype='object')
-    
     ccdat = ccdat.assign(year = pd.DatetimeIndex(ccdat['EndDate']).year)
     # ccdat = ccdat[ccdat['year'] >= 2010]
     ccdat = ccdat[['StartDate', 'EndDate', 'DNER_Districts', 'Intensity_Score', 'CoopCon']]
     ccdat.columns = ['sdate', 'edate', 'region', 'intensity', 'coop_con']
-    
-    # Aggregate conflict/coop and get ratio
-    ccdat2 = ccdat.apply(lambda x: proc_cc(x['sdate'], x['edate'], x['intensity'], x['region']), axis=1)
-    ccdat2 = pd.concat([x for x in ccdat2])
+    return expand_cc(ccdat, min_year=start_year)
 
-    # Keep full df
-    main_ccdat2 = ccdat2
-    main_ccdat2 = main_ccdat2.assign(region = main_ccdat2['region'].str.title())
-
-    # Aggreagete df
-    ccdat2 = ccdat2.assign(group_1 = np.where(ccdat2['intensity'] <= -1, 0, 1))
 
-    # Conflict count
-    conflict_count = ccdat2[ccdat2['group_1'] == 0].groupby(['year', 'month', 'region'])['group_1'].count().reset_index()
-    conflict_sum = ccdat2[ccdat2['group_1'] == 0].groupby(['year', 'month', 'region'])['intensity'].sum().reset_index()
-    conflict_mean = ccdat2[ccdat2['group_1'] == 0].groupby(['year', 'month', 'region'])['intensity'].mean().abs().reset_index()
-    
-    conflict_count = conflict_count.rename(columns={conflict_count.columns[-1]: 'conflict_count'})
-    conflict_sum = conflict_sum.rename(columns={conflict_sum.columns[-1]: 'conflict_sum'})
-    conflict_mean = conflict_mean.rename(columns={conflict_mean.columns[-1]: 'conflict_mean'})
-
-    # Coop count
-    coop_count = ccdat2[ccdat2['group_1'] == 1].groupby(['year', 'month', 'region'])['group_1'].count().reset_index()
-    coop_sum = ccdat2[ccdat2['group_1'] == 1].groupby(['year', 'month', 'region'])['intensity'].sum().reset_index()
-    coop_mean = ccdat2[ccdat2['group_1'] == 1].groupby(['year', 'month', 'region'])['intensity'].mean().abs().reset_index()
-    
-    coop_count = coop_count.rename(columns={coop_count.columns[-1]: 'coop_count'})
-    coop_sum = coop_sum.rename(columns={coop_sum.columns[-1]: 'coop_sum'})
-    coop_mean = coop_mean.rename(columns={coop_mean.columns[-1]: 'coop_mean'})
-    
-    # Merge
-    ccdat3 = conflict_count.merge(conflict_sum, on=['year', 'month','region'], how='left')
-    ccdat3 = ccdat3.merge(conflict_mean, on=['year', 'month','region'], how='left')
-    ccdat3 = ccdat3.merge(coop_count, on=['year', 'month','region'], how='left')
-    ccdat3 = ccdat3.merge(coop_sum, on=['year', 'month','region'], how='left')
-    ccdat3 = ccdat3.merge(coop_mean, on=['year', 'month','region'], how='left')
+def cc_tables(ccdat2, threshold):
+    # Keep full df
+    main_ccdat2 = ccdat2.assign(region = ccdat2['region'].str.title())
 
-    # Get ratios    
-    ccdat3 = ccdat3.assign(cc_ratio_count = ccdat3['conflict_count'] / ccdat3['coop_count'])
-    ccdat3 = ccdat3.assign(cc_ratio_sum = ccdat3['conflict_sum'] / ccdat3['coop_sum'])
-    ccdat3 = ccdat3.assign(cc_ratio_mean = ccdat3['conflict_mean'] / ccdat3['coop_mean'])
+    # Aggreagete df: conflict/coop counts, sums, means and ratios
+    ccdat3 = aggregate_cc(ccdat2, threshold=threshold)
     
     # Filter 2010
     # ccdat3 = ccdat3[(ccdat3['year'] >= 2010) & (ccdat3['year'] <= 2017)]
     ccdat3 = ccdat3.assign(region = ccdat3['region'].str.title())
-    
+    return ccdat3, main_ccdat2
+
+
+def load_landings(path=LANDINGS_FILE, dtypes=LANDINGS_DTYPES, cache_dir=LANDINGS_CACHE):
+    ### Typed landings, cached as a pickle keyed on the source (path, mtime, size) and schema
+    if cache_dir is not None:
+        stat = os.stat(path)
+        stamp = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{sorted(dtypes.items())}"
+        cache = os.path.join(cache_dir, hashlib.sha1(stamp.encode()).hexdigest() + '.pkl')
+        if os.path.exists(cache):
+            return pd.read_pickle(cache)
+
+    efdat = pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        efdat.to_pickle(cache + '.tmp')
+        os.replace(cache + '.tmp', cache)
+    return efdat
+
+
+def species_stats(efdat):
     # [2] Clean Fishing effort data
     # Index(['YEAR_LANDED', 'MONTH_LANDED', 'LANDING_LOCATION_COUNTY',
     #    'SPECIES_ITIS', 'ITIS_COMMON_NAME', 'ITIS_SCIENTIFIC_NAME',
     #    'POUNDS_LANDED', 'ADJUSTED_POUNDS', 'trips', 'fishers'],
     #   dtype='object')
-    
-    species = efdat.groupby(['ITIS_COMMON_NAME']).agg({'ADJUSTED_POUNDS': 'sum'}).sort_values('ADJUSTED_POUNDS', ascending=False).head(300).reset_index()
+
+    ### One pass over landings: (species, year) totals, float32 pounds summed in float64
+    values = ['POUNDS_LANDED', 'ADJUSTED_POUNDS', 'trips', 'fishers']
+    efdat = efdat.assign(POUNDS_LANDED = efdat['POUNDS_LANDED'].astype('float64'),
+                         ADJUSTED_POUNDS = efdat['ADJUSTED_POUNDS'].astype('float64'))
+    stats = efdat.groupby(['ITIS_COMMON_NAME', 'YEAR_LANDED'], observed=True)[values].sum()
+    return stats.reset_index()
+
+
+def species_tables(stats, n_species, n_top=10):
+    ### Ranking, top-N and coverage all derived from the small species_stats table
+    totals = stats.groupby('ITIS_COMMON_NAME', observed=True)[['POUNDS_LANDED', 'ADJUSTED_POUNDS']].sum()
+
+    species = totals[['ADJUSTED_POUNDS']].sort_values('ADJUSTED_POUNDS', ascending=False).head(n_species).reset_index()
     # species = species[~species['ITIS_COMMON_NAME'].isin(['LOBSTERS,SPINY', 'CONCH,QUEEN', 'OCTOPUS,UNSPECIFIED'])]
-    species = species['ITIS_COMMON_NAME'].ravel()
-    print(species)
+    species = species['ITIS_COMMON_NAME'].to_numpy()
 
     # Get top 10 species
-    top10_species = efdat.groupby('ITIS_COMMON_NAME').sum().reset_index().sort_values('POUNDS_LANDED', ascending=False).head(10)['ITIS_COMMON_NAME']
-    efdat_top10 = efdat[efdat['ITIS_COMMON_NAME'].isin(top10_species)]
-    efdat_top10 = efdat_top10.groupby(['YEAR_LANDED', 'ITIS_COMMON_NAME']).sum().reset_index()
-    efdat_top10.to_csv('data/top10_catch_species.csv', index=False)
+    top10_species = totals.reset_index().sort_values('POUNDS_LANDED', ascending=False).head(n_top)['ITIS_COMMON_NAME']
+    efdat_top10 = stats[stats['ITIS_COMMON_NAME'].isin(top10_species)]
+    efdat_top10 = efdat_top10.groupby(['YEAR_LANDED', 'ITIS_COMMON_NAME'], observed=True).sum().reset_index()
 
     # Calc perc catch from subset
-    fil_spec = efdat[efdat['ITIS_COMMON_NAME'].isin(species)].groupby('YEAR_LANDED')['ADJUSTED_POUNDS'].sum().reset_index()
-    full_spec = efdat.groupby('YEAR_LANDED')['ADJUSTED_POUNDS'].sum().reset_index()
-    calc_perc = fil_spec.merge(full_spec, on='YEAR_LANDED')                      
+    fil_spec = stats[stats['ITIS_COMMON_NAME'].isin(species)].groupby('YEAR_LANDED')['ADJUSTED_POUNDS'].sum().reset_index()
+    full_spec = stats.groupby('YEAR_LANDED')['ADJUSTED_POUNDS'].sum().reset_index()
+    calc_perc = fil_spec.merge(full_spec, on='YEAR_LANDED')
     calc_perc = calc_perc.assign(perc = calc_perc['ADJUSTED_POUNDS_x'] / calc_perc['ADJUSTED_POUNDS_y'])
-    print(calc_perc)
-    print(f"Average catch in sample: {np.round(calc_perc.perc.mean(), 3)*100}%")
-    
-    #        YEAR_LANDED  ADJUSTED_POUNDS_x  ADJUSTED_POUNDS_y      perc
-    # 0         2010       1.334739e+06       1.857560e+06  0.718544
-    # 1         2011       1.033816e+06       1.549942e+06  0.667003
-    # 2         2012       1.349670e+06       2.092686e+06  0.644946
-    # 3         2013       8.970195e+05       1.477108e+06  0.607281
-    # 4         2014       1.185775e+06       1.847903e+06  0.641687
-    # 5         2015       1.208846e+06       1.918117e+06  0.630226
-    # 6         2016       1.098157e+06       1.884955e+06  0.582590
-    # 7         2017       7.714999e+05       1.308595e+06  0.589563
-    # 8         2018       9.707479e+05       1.825380e+06  0.531806
-    # 9         2019       1.261108e+06       1.928243e+06  0.654019
-    
-    # array(['LOBSTERS,SPINY', 'CONCH,QUEEN', 'SNAPPER,SILK', 'SNAPPER,QUEEN',
-    #    'SNAPPER,YELLOWTAIL', 'SNAPPER,LANE', 'DOLPHINFISH',
-    #    'TRIGGERFISH,QUEEN', 'HOGFISH', 'BOXFISH,UNSPECIFIED',
-    #    'GROUPER,RED HIND', 'TUNA,BLACKFIN', 'SNAPPER,MUTTON', 'BALLYHOO',
-    #    'PARROTFISHES,UNSPECIFIED', 'SNAPPER,UNSPECIFIED',
-    #    'OCTOPUS,UNSPECIFIED', 'MACKEREL,KING', 'JACK,BAR',
-    #    'TUNA,SKIPJACK', 'MACKEREL,CERO', 'WAHOO', 'HERRING,SARDINELLA',
-    #    'TUNNY,LITTLE', 'PORGY,UNSPECIFIED', 'GRUNT,UNSPECIFIED',
-    #    'SNAPPER,CARDINAL', 'MULLET,WHITE', 'SNAPPER,VERMILION',
-    #    'GRUNT,WHITE'], dtype=object)
-    
-    pricedat = pd.read_csv('data/PR_Fish_Species_Prices_2010_2018.csv')
+    return species, efdat_top10, calc_perc
+
+
+def clean_prices(path):
+    pricedat = pd.read_csv(path)
 
     # Clean pricing data
     pricedat = pricedat.set_index('SPECIES').unstack().reset_index()
@@ -462,16 +1684,22 @@ if __name__ == "__main__":
     # pricedat['species'] = pricedat['species'].astype(str)
     pricedat['year'] = pricedat['year'].astype(int)
     pricedat['price'] = pricedat['price'].astype(float)
-    pricedat['species'].unique()
 
     # Average each species price
     pricedat = pricedat.groupby(['species', 'region']).agg({'price': 'mean'}).reset_index()
-    
+    return pricedat
+
+
+def build_effort(path, efdat, species_tbl, pricedat):
+    cdat = pd.read_csv(path)
+    species = species_tbl[0]
+
     # Filter top 30 species
     efdat2 = efdat[efdat['ITIS_COMMON_NAME'].isin(species)]
     
     efdat2 = efdat2[['YEAR_LANDED', 'MONTH_LANDED', 'LANDING_LOCATION_COUNTY', 'ITIS_COMMON_NAME', 'ADJUSTED_POUNDS', 'trips', 'fishers']]
     efdat2.columns = ['year', 'month', 'county', 'species', 'pounds', 'trips', 'fishers']
+    efdat2 = efdat2.assign(county = efdat2['county'].astype(str), pounds = efdat2['pounds'].astype('float64'))
     efdat2 = efdat2.merge(cdat, on=['county'], how='left')
 
     efdat2 = efdat2.assign(species = efdat2['species'].str.strip())
@@ -484,39 +1712,335 @@ if __name__ == "__main__":
     
     # aggregate species
     efdat3 = efdat2.groupby(['year', 'month', 'region']).agg({'pounds': 'sum', 'trips': 'sum', 'fishers': 'sum', 'price': 'mean'})
-    efdat3 = efdat3.reset_index()
+    return efdat3.reset_index()
 
-    efdat3.to_csv('data/PR_EFFORT_PRICES.csv', index=False)
+
+def covariate_tables(hurr_path, noi_path, sst, chl, wind, ssh, area_df):
+    # hurr = pd.read_csv('data/PR_Hurricane_daily_regional_2010-2019', index_col=False)
+    hurr = pd.read_csv(hurr_path, index_col=False)
+    noi = pd.read_csv(noi_path)
+
+    # Hurricane
+    # hurr = hurr.assign(month=pd.to_datetime(hurr['date']).dt.month, year=pd.to_datetime(hurr['date']).dt.year)
+    # hurr['hurricane'] = np.where(hurr['hurricane'] >= 1, 1, 0)
+
+    return [(sst, ['year', 'month', 'region']),
+            (chl, ['year', 'month', 'region']),
+            (wind, ['year', 'month', 'region']),
+            (ssh, ['year', 'month', 'region']),
+            (hurr, ['year', 'month', 'region']),
+            (noi, ['year', 'month']),
+            (area_df, ['region'])]
+
+
+def build_panels(efdat3, cc_tbl, covariates):
+    ccdat3, main_ccdat2 = cc_tbl
 
     # [3] Merge all data
-    regdat = efdat3.merge(ccdat3, on=['year', 'month', 'region'], how='left')
-    regdat = regdat.merge(sst, on=['year', 'month', 'region'], how='left')
-    regdat = regdat.merge(chl, on=['year', 'month', 'region'], how='left')
-    regdat = regdat.merge(wind, on=['year', 'month', 'region'], how='left')
-    regdat = regdat.merge(ssh, on=['year', 'month', 'region'], how='left')
-    regdat = regdat.merge(hurr, on=['year', 'month', 'region'], how='left')
-    regdat = regdat.merge(noi, on=['year', 'month'], how='left')
-    regdat = regdat.merge(area_df, on=['region'], how='left')
+    regdat, mregdat = assemble_panels(efdat3, ccdat3, main_ccdat2, covariates)
+
     regdat['hurricane'] = regdat.hurricane.fillna(0)
     regdat = regdat.dropna()
-    
-    print("Saving: 'data/FULL_PR_regdat_monthly.csv'")
-    regdat.to_csv('data/FULL_PR_regdat_monthly.csv', index=False)
 
     # Keep df with all ob
-    mregdat = efdat3.merge(main_ccdat2, on=['year', 'month', 'region'], how='left')
-    mregdat = mregdat.merge(sst, on=['year', 'month', 'region'], how='left')
-    mregdat = mregdat.merge(chl, on=['year', 'month', 'region'], how='left')
-    mregdat = mregdat.merge(wind, on=['year', 'month', 'region'], how='left')
-    mregdat = mregdat.merge(ssh, on=['year', 'month', 'region'], how='left')
-    mregdat = mregdat.merge(hurr, on=['year', 'month', 'region'], how='left')
-    mregdat = mregdat.merge(noi, on=['year', 'month'], how='left')
-    mregdat = mregdat.merge(area_df, on=['region'], how='left')
     mregdat['hurricane'] = mregdat.hurricane.fillna(0)
     mregdat = mregdat.dropna()
+    return regdat, mregdat
+
+
+#%%
+def scenario_grid(grid):
+    ### Every combination of the grid values, parameters not in the grid at the single-run values
+    defaults = {'cc_file': CC_FILE, 'start_year': START_YEAR, 'max_year': None, 'threshold': CC_THRESHOLD,
+                'min_intensity': None, 'n_species': N_SPECIES, 'species': None}
+    unknown = sorted(set(grid) - set(defaults))
+    if unknown:
+        raise ValueError(f"Unknown scenario parameters: {unknown}")
+    return [{**defaults, **dict(zip(grid, values))} for values in itertools.product(*grid.values())]
+
+
+def scenario_name(scenario):
+    return hashlib.sha1(json.dumps(scenario, sort_keys=True).encode()).hexdigest()[:12]
+
+
+### Tables shared by all scenarios, set once per worker process by the pool initializer
+_shared = {}
+
+def init_scenarios(shared):
+    _shared.update(shared)
+
+
+def build_scenario(scenario, out_dir):
+    ### Only the cheap steps: event filters, conflict aggregation, species subset, effort and merge
+    events = _shared['cc_events'][(scenario['cc_file'], scenario['start_year'])]
+    if scenario['min_intensity'] is not None:
+        events = events[events['intensity'].abs() >= scenario['min_intensity']]
+    if scenario['max_year'] is not None:
+        events = events[events['year'] <= scenario['max_year']]
+    cc_tbl = cc_tables(events, scenario['threshold'])
+
+    if scenario['species'] is not None:
+        species = np.asarray(scenario['species'])
+    else:
+        species = species_tables(_shared['species_stats'], scenario['n_species'])[0]
+    efdat3 = build_effort(_shared['municipalities'], _shared['landings'], (species,), _shared['prices'])
+    if scenario['max_year'] is not None:
+        efdat3 = efdat3[efdat3['year'] <= scenario['max_year']]
+
+    regdat, mregdat = build_panels(efdat3, cc_tbl, _shared['covariates'])
+
+    name = scenario_name(scenario)
+    path = os.path.join(out_dir, name)
+    os.makedirs(path, exist_ok=True)
+    for df, prefix in [(regdat, 'FULL'), (mregdat, 'UNAGG')]:
+        df.to_csv(os.path.join(path, f'{prefix}_PR_regdat_monthly.csv'), index=False)
+        if FILE_FORMAT == 'parquet':
+            df.to_parquet(os.path.join(path, f'{prefix}_PR_regdat_monthly.parquet'), index=False)
+    with open(os.path.join(path, 'scenario.json'), 'w') as f:
+        json.dump(scenario, f, indent=1)
+    return {'scenario': name, **{k: json.dumps(v) if isinstance(v, (list, tuple)) else v for k, v in scenario.items()},
+            'rows_full': len(regdat), 'rows_unagg': len(mregdat)}
+
+
+def run_scenarios(grid, covariates, efdat, stats, pricedat, municipalities, out_dir=SCENARIO_DIR, ncores=NCORES):
+    ### Shared tables (covariates, landings aggregates, expanded events per FCCE file) are built once
+    ### and sent to each worker once; scenarios fan out over the pool, one panel directory each
+    scenarios = scenario_grid(grid)
+    cc_events = {}
+    for scenario in scenarios:
+        key = (scenario['cc_file'], scenario['start_year'])
+        if key not in cc_events:
+            cc_events[key] = load_cc(*key)
+    shared = {'covariates': covariates, 'landings': efdat, 'species_stats': stats, 'prices': pricedat,
+              'municipalities': municipalities, 'cc_events': cc_events}
+
+    os.makedirs(out_dir, exist_ok=True)
+    log(f"{out_dir}: {len(scenarios)} scenarios")
+    progress = Progress(out_dir, len(scenarios))
+    index = []
+    failed = {}
+    with ProcessPoolExecutor(max_workers=min(ncores, len(scenarios)), initializer=init_scenarios, initargs=(shared,)) as pool:
+        futures = {pool.submit(build_scenario, scenario, out_dir): scenario for scenario in scenarios}
+        for fut in as_completed(futures):
+            name = scenario_name(futures[fut])
+            if fut.exception() is not None:
+                failed[name] = fut.exception()
+                log(f"Failed: scenario {name} ... {fut.exception()!r}")
+            else:
+                index.append(fut.result())
+            progress.update()
+
+    index = pd.DataFrame(index)
+    if len(index):
+        index = index.sort_values('scenario')
+    index.to_csv(os.path.join(out_dir, 'scenarios.csv'), index=False)
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(scenarios)} scenarios failed: {sorted(failed)}")
+    return index
+
+
+#%%
+class StageGraph:
+    ### Each stage is cached on disk under a key built from its code, input file contents,
+    ### parameters and the keys of the stages it depends on, so only changed stages rerun
+
+    def __init__(self, cache_dir=STAGE_CACHE):
+        self.cache_dir = cache_dir
+        self.keys = {}
+        self.values = {}
+        os.makedirs(os.path.join(cache_dir, 'files'), exist_ok=True)
+
+    def file_digest(self, path):
+        ### Content hash, memoized on (path, mtime, size) so unchanged files are read once; one memo
+        ### per path, overwritten when the file changes
+        if os.path.isdir(path):
+            files = sorted(os.path.join(d, x) for d, _, xs in os.walk(path) for x in xs)
+            return hashlib.sha256(''.join(self.file_digest(x) for x in files).encode()).hexdigest()
+
+        stat = os.stat(path)
+        stamp = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+        memo = os.path.join(self.cache_dir, 'files', hashlib.sha1(os.path.abspath(path).encode()).hexdigest())
+        if os.path.exists(memo):
+            with open(memo) as f:
+                memo_stamp, memo_digest = f.read().rsplit('|', 1)
+            if memo_stamp == stamp:
+                return memo_digest
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        write_atomic(memo, f"{stamp}|{digest.hexdigest()}".encode())
+        return digest.hexdigest()
+
+    def stage_key(self, name, func, inputs, stamps, deps, code, params):
+        key = hashlib.sha256(name.encode())
+        key.update(code_digest([func] + list(code)).encode())
+        for path in inputs:
+            key.update(f"{path}|{self.file_digest(path)}".encode())
+
+        ### Large raw archives are keyed on (path, mtime, size) rather than content
+        for path in stamps:
+            stat = os.stat(path)
+            key.update(f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}".encode())
+        for dep in deps:
+            key.update(self.keys[dep].encode())
+        key.update(json.dumps(params, sort_keys=True, default=repr).encode())
+        return key.hexdigest()[:16]
+
+    def run(self, name, func, inputs=(), stamps=(), deps=(), code=(), complete=None, **params):
+        ### func(*inputs, *dependency outputs, **params), instrumented when a run report is active;
+        ### a value for which complete(value) is False is used but not cached, so the next run retries
+        with (REPORT.stage(name) if REPORT is not None else contextlib.nullcontext({})) as record:
+            key = self.stage_key(name, func, inputs, stamps, deps, code, params)
+            out = os.path.join(self.cache_dir, f'{name}-{key}.pkl')
+            record.update({'key': key, 'cached': os.path.exists(out),
+                           'input_bytes': sum(os.path.getsize(x) for x in list(inputs) + list(stamps) if os.path.isfile(x)),
+                           'rows_in': sum(count_rows(self.values[x]) or 0 for x in deps)})
+            if record['cached']:
+                log(f"Stage {name}: cached ({key})")
+                with open(out, 'rb') as f:
+                    value = pickle.load(f)
+            else:
+                log(f"Stage {name}: running ({key})")
+                value = func(*inputs, *[self.values[x] for x in deps], **params)
+                if complete is None or complete(value):
+                    write_atomic(out, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+                    self.prune(name, key)
+                else:
+                    log(f"Stage {name}: incomplete, not cached ({key})")
+            record['rows_out'] = count_rows(value)
+
+        self.keys[name] = key
+        self.values[name] = value
+        return value
+
+    def prune(self, name, key):
+        ### Drop the stage's pickles from earlier keys, only the newest output of each stage is kept
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), f"{glob.escape(name)}-{'[0-9a-f]' * 16}.pkl")):
+            if path != os.path.join(self.cache_dir, f'{name}-{key}.pkl'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+
+#%%
+if __name__ == "__main__":
+    ### Run report written on exit, also when a stage fails
+    REPORT = RunReport()
+    atexit.register(REPORT.write)
+
+    # ### Dask setup    
+    # NCORES = 30
+    # client = Client(n_workers=NCORES, threads_per_worker=1)
+
+    # ### Daily regional tables (only needed with STREAM_MONTHLY = False)
+    # # ### Get SST
+    # proc_sst()
+
+    # ### Get CHL
+    # files = gridded_files('chl')
+    # parts = run_partitioned(partial(get_chl, regions=REGIONS), files, 'data/partitions/chl')
+    # combine_partitions(parts, 'chl')
+
+    # ### Get Sea Surface Height
+    # files = gridded_files('ssh')
+    # parts = run_partitioned(partial(get_ssh, regions=REGIONS), files, 'data/partitions/ssh')
+    # combine_partitions(parts, 'ssh')
+
+
+    # ### Hurricane data
+    # # August 2014; August 2015; Sept 2017; July 2018; August 2019; Sept 2019
+    # hurr_events = ['2014-08', '2015-08', '2017-09', '2018-07', '2019-08', '2019-09']
+    # dates = [i.strftime("%Y-%m") for i in pd.date_range(start="2010-01-01", end="2019-12-01", freq='MS')]
+    # hurr_dat = pd.DataFrame({'date': dates, "hurricane": 0})
+    # hurr_dat = hurr_dat.assign(hurricane = np.where(hurr_dat['date'].isin(hurr_events), 1, 0))
+    # hurr_dat.to_csv('data/PR_Hurricane_daily_regional_2010-2019', index=False)
+    
+
+    # ### Download PODACC SSH files
+    # download_ssh_data()
+
+
+    # -------------------------------------------------------------------------
+    # Monthly estimates, each stage cached and rerun only when its inputs change
+    # (keys cover every module function and setting a stage reaches, see code_closure)
+    stages = StageGraph()
+
+    # Get area of region
+    stages.run('area', region_areas, regions=REGIONS)
+
+    # SST, CHL, SSH
+    for variable in ['sst', 'chl', 'ssh']:
+        ### The daily path reads the daily regional tables
+        daily = daily_files(variable) if not (OUT_OF_CORE or STREAM_MONTHLY) else []
+        stages.run(variable, env_monthly, stamps=gridded_files(variable) + daily,
+                   variable=variable, regions=REGIONS, start_year=START_YEAR, weighted=AREA_WEIGHTED, out_of_core=OUT_OF_CORE)
+
+    # Wind (not cached while any buoy-year failed for a reason other than 404)
+    stages.run('wind', wind_monthly, complete=wind_complete, tasks=WIND_TASKS, start_year=START_YEAR, regions=list(REGIONS))
+
+    stages.run('covariates', covariate_tables, inputs=['data/hurricanes_138km.csv', 'data/NOI_Index.csv'],
+               deps=['sst', 'chl', 'wind', 'ssh', 'area'])
+
+    # ------------------------------------------------
+    # Monthly Puerto Rico Data    
+    stages.run('cc_events', load_cc, inputs=[CC_FILE], start_year=START_YEAR)
+    stages.run('cc', cc_tables, deps=['cc_events'], threshold=CC_THRESHOLD)
+
+    ### The stage pickle is already the binary cache, so skip the loader's own
+    efdat = stages.run('landings', load_landings, inputs=[LANDINGS_FILE], dtypes=LANDINGS_DTYPES, cache_dir=None)
+    stages.run('species_stats', species_stats, deps=['landings'])
+    species, efdat_top10, calc_perc = stages.run('species', species_tables, deps=['species_stats'], n_species=N_SPECIES)
+    print(species)
+    efdat_top10.to_csv('data/top10_catch_species.csv', index=False)
+    print(calc_perc)
+    print(f"Average catch in sample: {np.round(calc_perc.perc.mean(), 3)*100}%")
+    
+    #        YEAR_LANDED  ADJUSTED_POUNDS_x  ADJUSTED_POUNDS_y      perc
+    # 0         2010       1.334739e+06       1.857560e+06  0.718544
+    # 1         2011       1.033816e+06       1.549942e+06  0.667003
+    # 2         2012       1.349670e+06       2.092686e+06  0.644946
+    # 3         2013       8.970195e+05       1.477108e+06  0.607281
+    # 4         2014       1.185775e+06       1.847903e+06  0.641687
+    # 5         2015       1.208846e+06       1.918117e+06  0.630226
+    # 6         2016       1.098157e+06       1.884955e+06  0.582590
+    # 7         2017       7.714999e+05       1.308595e+06  0.589563
+    # 8         2018       9.707479e+05       1.825380e+06  0.531806
+    # 9         2019       1.261108e+06       1.928243e+06  0.654019
     
+    # array(['LOBSTERS,SPINY', 'CONCH,QUEEN', 'SNAPPER,SILK', 'SNAPPER,QUEEN',
+    #    'SNAPPER,YELLOWTAIL', 'SNAPPER,LANE', 'DOLPHINFISH',
+    #    'TRIGGERFISH,QUEEN', 'HOGFISH', 'BOXFISH,UNSPECIFIED',
+    #    'GROUPER,RED HIND', 'TUNA,BLACKFIN', 'SNAPPER,MUTTON', 'BALLYHOO',
+    #    'PARROTFISHES,UNSPECIFIED', 'SNAPPER,UNSPECIFIED',
+    #    'OCTOPUS,UNSPECIFIED', 'MACKEREL,KING', 'JACK,BAR',
+    #    'TUNA,SKIPJACK', 'MACKEREL,CERO', 'WAHOO', 'HERRING,SARDINELLA',
+    #    'TUNNY,LITTLE', 'PORGY,UNSPECIFIED', 'GRUNT,UNSPECIFIED',
+    #    'SNAPPER,CARDINAL', 'MULLET,WHITE', 'SNAPPER,VERMILION',
+    #    'GRUNT,WHITE'], dtype=object)
+    
+    stages.run('prices', clean_prices, inputs=['data/PR_Fish_Species_Prices_2010_2018.csv'])
+    MUNICIPALITIES = './data/Municipalities_by_region_Puerto_Rico_wideFormat.csv'
+    efdat3 = stages.run('effort', build_effort, inputs=[MUNICIPALITIES],
+                        deps=['landings', 'species', 'prices'])
+    efdat3.to_csv('data/PR_EFFORT_PRICES.csv', index=False)
+
+    # [3] Merge all data
+    regdat, mregdat = stages.run('panels', build_panels, deps=['effort', 'cc', 'covariates'])
+    
+    print("Saving: 'data/FULL_PR_regdat_monthly.csv'")
+    regdat.to_csv('data/FULL_PR_regdat_monthly.csv', index=False)
+    if FILE_FORMAT == 'parquet':
+        regdat.to_parquet('data/FULL_PR_regdat_monthly.parquet', index=False)
+
+    # Keep df with all ob
     print("Saving: 'data/UNAGG_PR_regdat_monthly.csv'")
     mregdat.to_csv('data/UNAGG_PR_regdat_monthly.csv', index=False)
+    if FILE_FORMAT == 'parquet':
+        mregdat.to_parquet('data/UNAGG_PR_regdat_monthly.parquet', index=False)
 
-
-    
\ No newline at end of file
+    # ------------------------------------------------
+    # Scenario batch: one panel per grid combination, reusing the shared stages above
+    if SCENARIOS is not None:
+        run_scenarios(SCENARIOS, stages.values['covariates'], efdat, stages.values['species_stats'],
+                      stages.values['prices'], MUNICIPALITIES)
@@ -0,0 +1,413 @@
+#%%
+### Benchmark harness for 1-Data-step.py
+###
+### Generates synthetic inputs (global daily grids, NDBC text, FCCE events, landings, prices)
+### at a chosen scale, runs each pipeline stage in its own subprocess and reports wall time,
+### CPU time and the stage's own peak RSS as JSON so runs can be compared across commits.
+###
+###   python benchmark.py --scale small --root bench_data --out bench.json
+###   python benchmark.py --scale small --root bench_data --compare bench.json
+import pandas as pd
+import numpy as np
+import xarray as xr
+import dask.array as da
+import os
+import sys
+import gzip
+import json
+import time
+import glob
+import pickle
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import http.server
+import importlib.util
+from functools import partial
+
+
+#%%
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '1-Data-step.py')
+
+### Grid resolutions (degrees), years, days per year, CHL files every n days, table sizes
+SCALES = {'small': {'years': 1, 'days': 30, 'sst_res': 1.0, 'chl_res': 1 / 6, 'ssh_res': 1 / 2, 'chl_every': 5,
+                    'landings': 20000, 'events': 400},
+          'medium': {'years': 2, 'days': 365, 'sst_res': 0.25, 'chl_res': 1 / 12, 'ssh_res': 1 / 6, 'chl_every': 1,
+                     'landings': 200000, 'events': 2000},
+          'full': {'years': 10, 'days': 365, 'sst_res': 0.25, 'chl_res': 1 / 24, 'ssh_res': 1 / 6, 'chl_every': 1,
+                   'landings': 2000000, 'events': 10000}}
+
+COUNTIES = {'San Juan': 'North', 'Arecibo': 'North', 'Ponce': 'South', 'Guanica': 'South',
+            'Fajardo': 'East', 'Naguabo': 'East', 'Mayaguez': 'West', 'Rincon': 'West'}
+SPECIES = [f'FISH,{i:03d}' for i in range(400)]
+MISSING_BUOY = '41053'
+OLD_FORMAT_BUOY = 'mgip4'
+
+
+#%%
+def make_sst(path, year, days, res, rng):
+    ### NOAA OISST layout: (time, lat, lon), ascending lat, 0-360 lon; written 30 days at a time
+    lat = np.arange(-90 + res / 2, 90, res)
+    lon = np.arange(res / 2, 360, res)
+    time_ = pd.date_range(f'{year}-01-01', periods=days)
+    land = rng.random((len(lat), len(lon))) < 0.3
+    sst = da.random.RandomState(int(rng.integers(1e9))).normal(26, 1, (days, len(lat), len(lon)),
+                                                                chunks=(30, len(lat), len(lon))).astype('float32')
+    sst = da.where(land, np.float32(np.nan), sst)
+    xr.Dataset({'sst': (('time', 'lat', 'lon'), sst)},
+               coords={'time': time_, 'lat': lat, 'lon': lon}).to_netcdf(path)
+
+
+def make_chl(path, res, rng):
+    ### MODIS L3m layout: (lat, lon), descending lat, -180-180 lon, palette variable, 30% cloud gaps
+    lat = np.arange(90 - res / 2, -90, -res)
+    lon = np.arange(-180 + res / 2, 180, res)
+    chl = rng.lognormal(-1, 0.5, (len(lat), len(lon))).astype('float32')
+    chl[rng.random(chl.shape) < 0.3] = np.nan
+    xr.Dataset({'chlor_a': (('lat', 'lon'), chl),
+                'palette': (('rgb', 'eightbitcolor'), np.zeros((3, 256), 'uint8'))},
+               coords={'lat': lat, 'lon': lon}).to_netcdf(path)
+
+
+def make_ssh(path, when, res, rng):
+    ### PODAAC cdr_grid layout: (Time, Longitude, Latitude), 0-360 lon, Time_bounds
+    lat = np.arange(-80 + res / 2, 80, res)
+    lon = np.arange(res / 2, 360, res)
+    sla = rng.normal(0, 0.1, (1, len(lon), len(lat))).astype('float32')
+    sla[0, ::7, ::5] = np.nan
+    xr.Dataset({'SLA': (('Time', 'Longitude', 'Latitude'), sla),
+                'SLA_ERR': (('Time', 'Longitude', 'Latitude'), np.abs(sla) / 3),
+                'Time_bounds': (('Time', 'nv'), np.array([[when, when + pd.Timedelta('5D')]], dtype='datetime64[ns]'))},
+               coords={'Time': [when], 'Latitude': lat, 'Longitude': lon}).to_netcdf(path)
+
+
+def stdmet_text(year, days=365, seed=0, old=False):
+    ### Gzipped NDBC historical stdmet file (hourly, 99/999 sentinels); old=True is the pre-2007 header
+    rng = np.random.default_rng(seed)
+    time_ = pd.date_range(f'{year}-01-01', periods=days * 24, freq='h')
+    wdir = rng.integers(0, 360, len(time_))
+    wspd = np.round(rng.uniform(0, 12, len(time_)), 1)
+    wdir[::17] = 999
+    wspd[::23] = 99.0
+
+    if old:
+        lines = ["YYYY MM DD hh  WD  WSPD GST  WVHT   DPD   APD MWD  BAR    ATMP  WTMP  DEWP  VIS  TIDE"]
+        minute = ""
+    else:
+        lines = ["#YY  MM DD hh mm WDIR WSPD GST  WVHT   DPD   APD MWD   PRES  ATMP  WTMP  DEWP  VIS  TIDE",
+                 "#yr  mo dy hr mn degT m/s  m/s     m   sec   sec degT   hPa  degC  degC  degC  nmi    ft"]
+        minute = " 00"
+    for ts, d, s in zip(time_, wdir, wspd):
+        lines.append(f"{ts.year:4d} {ts.month:02d} {ts.day:02d} {ts.hour:02d}{minute} {d:3d} {s:4.1f} {s + 1:4.1f} "
+                     "99.00 99.00 99.00 999 1015.0  25.1  26.2 999.0 99.0 99.00")
+    return gzip.compress(("\n".join(lines) + "\n").encode())
+
+
+def make_tables(data, years, n_landings, n_events, rng):
+    ### Landings, municipalities, FCCE events, prices, NOI and hurricane tables in the pipeline's layouts
+    p = 1 / np.arange(1, len(SPECIES) + 1)
+    species = rng.choice(SPECIES, n_landings, p=p / p.sum())
+    pounds = np.round(rng.gamma(2, 50, n_landings), 1)
+    pd.DataFrame({'YEAR_LANDED': rng.choice(years, n_landings),
+                  'MONTH_LANDED': rng.integers(1, 13, n_landings),
+                  'LANDING_LOCATION_COUNTY': rng.choice(list(COUNTIES), n_landings),
+                  'SPECIES_ITIS': rng.integers(1e5, 1e6, n_landings),
+                  'ITIS_COMMON_NAME': species,
+                  'ITIS_SCIENTIFIC_NAME': np.char.replace(species.astype(str), 'FISH', 'PISCIS'),
+                  'POUNDS_LANDED': pounds,
+                  'ADJUSTED_POUNDS': np.round(pounds * 1.05, 2),
+                  'trips': rng.integers(1, 10, n_landings),
+                  'fishers': rng.integers(1, 5, n_landings)}).to_csv(f'{data}/PR_nonconf_landings_2010_19_2021-01-07.CSV', index=False)
+    pd.DataFrame({'county': list(COUNTIES), 'region': list(COUNTIES.values())}).to_csv(
+        f'{data}/Municipalities_by_region_Puerto_Rico_wideFormat.csv', index=False)
+
+    start = pd.Timestamp(f'{years[0] - 1}-06-01') + pd.to_timedelta(rng.integers(0, 365 * (len(years) + 1), n_events), 'D')
+    end = start + pd.to_timedelta(rng.integers(0, 200, n_events), 'D')
+    districts = [', '.join(rng.choice(['NORTH', 'SOUTH', 'EAST', 'WEST'], rng.integers(1, 3), replace=False)) for _ in range(n_events)]
+    pd.DataFrame({'StartDate': start.strftime('%m/%d/%Y'), 'EndDate': end.strftime('%m/%d/%Y'),
+                  'DNER_Districts': districts,
+                  'Intensity_Score': rng.choice([-5, -4, -3, -2, -1, 1, 2, 3, 4, 5], n_events),
+                  'CoopCon': 1}).to_csv(f'{data}/FCCE_Master_Intensity_Expanded_zeros_excluded.csv', index=False)
+
+    prices = {'SPECIES': [f' {x} ' for x in SPECIES[:100]]}
+    for year in years:
+        for region in 'NSEW':
+            price = np.round(rng.uniform(1, 8, 100), 2).astype(str).astype(object)
+            price[rng.random(100) < 0.1] = '  '
+            prices[f'{year}-{region}'] = price
+    pd.DataFrame(prices).to_csv(f'{data}/PR_Fish_Species_Prices_2010_2018.csv', index=False)
+
+    months = pd.MultiIndex.from_product([range(years[0] - 1, years[-1] + 1), range(1, 13)], names=['year', 'month']).to_frame(index=False)
+    months.assign(noi = rng.normal(0, 1, len(months))).to_csv(f'{data}/NOI_Index.csv', index=False)
+    hurr = pd.MultiIndex.from_product([years, range(1, 13), ['North', 'South', 'East', 'West']],
+                                      names=['year', 'month', 'region']).to_frame(index=False)
+    hurr.sample(frac=0.1, random_state=1).assign(hurricane = 1).to_csv(f'{data}/hurricanes_138km.csv', index=False)
+
+
+def make_fixtures(root, scale, seed=0):
+    ### Skip when the root already holds fixtures for this scale
+    params = SCALES[scale]
+    marker = os.path.join(root, 'fixtures.json')
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == {'scale': scale, 'seed': seed, **params}:
+                return
+    shutil.rmtree(root, ignore_errors=True)
+
+    rng = np.random.default_rng(seed)
+    years = list(range(2010, 2010 + params['years']))
+    for x in ['sst', 'chl', 'ssh', 'data']:
+        os.makedirs(os.path.join(root, 'grid' if x != 'data' else '', x), exist_ok=True)
+
+    for year in years:
+        print(f"Fixtures: {year}")
+        make_sst(f'{root}/grid/sst/sst.day.mean.{year}.nc', year, params['days'], params['sst_res'], rng)
+        for day in range(1, params['days'] + 1, params['chl_every']):
+            make_chl(f'{root}/grid/chl/A{year}{day:03d}.L3m_DAY_CHL_chlor_a_4km.nc', params['chl_res'], rng)
+    for when in pd.date_range(f'{years[0] - 1}-12-27 12:00', f'{years[-1]}-12-31', freq='5D'):
+        if when.dayofyear <= params['days'] or when.year < years[0]:
+            make_ssh(f'{root}/grid/ssh/ssh_grids_v1812_{when:%Y%m%d%H}.nc', when, params['ssh_res'], rng)
+    make_tables(f'{root}/data', years, params['landings'], params['events'], rng)
+
+    with open(marker, 'w') as f:
+        json.dump({'scale': scale, 'seed': seed, **params}, f)
+
+
+#%%
+class NDBCHandler(http.server.BaseHTTPRequestHandler):
+    ### Serves <buoy>h<year>.txt.gz like the NDBC archive, one buoy always missing, one in the old layout
+    days = 365
+
+    def do_GET(self):
+        buoy_id, year = os.path.basename(self.path).split('.')[0].split('h')
+        if buoy_id == MISSING_BUOY:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = stdmet_text(int(year), self.days, seed=sum(map(ord, buoy_id)) + int(year), old=buoy_id == OLD_FORMAT_BUOY)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_ndbc(days):
+    NDBCHandler.days = days
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), NDBCHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}/stdmet'
+
+
+def load_pipeline(root):
+    ### Import 1-Data-step.py as a module, pointed at the fixtures
+    spec = importlib.util.spec_from_file_location('data_step', PIPELINE)
+    m = importlib.util.module_from_spec(spec)
+    sys.modules['data_step'] = m
+    spec.loader.exec_module(m)
+
+    m.GRIDDED.update({x: f'{root}/grid/{x}/*.nc' for x in ['sst', 'chl', 'ssh']})
+    ### The fixtures only hold the benchmark years, so drop the 2010-2019 SST file cut
+    m.gridded_files = lambda variable: sorted(glob.glob(m.GRIDDED[variable]))
+    return m
+
+
+#%%
+def stage_table(m, root, scale):
+    ### name: (upstream stages, setup before timing, timed call)
+    params = SCALES[scale]
+    years = list(range(2010, 2010 + params['years']))
+    tasks = [(x, y, region) for region, buoys in m.BUOYS.items() for x in buoys for y in years]
+    first = lambda variable: m.gridded_files(variable)[0]
+
+    def cold(variable):
+        ### Cold run: no resumable partitions, region index or cached subsets left from earlier runs
+        shutil.rmtree(f'data/partitions/{variable}_monthly', ignore_errors=True)
+        shutil.rmtree('data/cache/regions', ignore_errors=True)
+        shutil.rmtree('data/cache/subsets', ignore_errors=True)
+
+    def wind(url):
+        shutil.rmtree('data/cache/ndbc_bench', ignore_errors=True)
+        return m.wind_monthly(tasks, base_url=url, cache_dir='data/cache/ndbc_bench')
+
+    stages = {'extract_sst': ([], lambda: cold('sst'), lambda d, x: m.get_sst(first('sst'))),
+              'extract_chl': ([], lambda: cold('chl'), lambda d, x: m.get_chl(first('chl'))),
+              'extract_ssh': ([], lambda: cold('ssh'), lambda d, x: m.get_ssh(first('ssh'))),
+              'area': ([], None, lambda d, x: m.region_areas(m.REGIONS)),
+              'wind': ([], lambda: serve_ndbc(params['days']), lambda d, url: wind(url)),
+              'cc_events': ([], None, lambda d, x: m.load_cc(m.CC_FILE, m.START_YEAR)),
+              'cc': (['cc_events'], None, lambda d, x: m.cc_tables(d['cc_events'], m.CC_THRESHOLD)),
+              'landings': ([], None, lambda d, x: m.load_landings(m.LANDINGS_FILE, cache_dir=None)),
+              'species_stats': (['landings'], None, lambda d, x: m.species_stats(d['landings'])),
+              'species': (['species_stats'], None, lambda d, x: m.species_tables(d['species_stats'], m.N_SPECIES)),
+              'prices': ([], None, lambda d, x: m.clean_prices('data/PR_Fish_Species_Prices_2010_2018.csv')),
+              'effort': (['landings', 'species', 'prices'], None,
+                         lambda d, x: m.build_effort('data/Municipalities_by_region_Puerto_Rico_wideFormat.csv',
+                                                     d['landings'], d['species'], d['prices'])),
+              'covariates': (['sst', 'chl', 'wind', 'ssh', 'area'], None,
+                             lambda d, x: m.covariate_tables('data/hurricanes_138km.csv', 'data/NOI_Index.csv',
+                                                             d['sst'], d['chl'], d['wind'], d['ssh'], d['area'])),
+              'panels': (['effort', 'cc', 'covariates'], None, lambda d, x: m.build_panels(d['effort'], d['cc'], d['covariates']))}
+
+    def monthly(variable, out_of_core, d, x):
+        return m.env_monthly(variable, m.REGIONS, m.START_YEAR, out_of_core=out_of_core)
+
+    for variable in ['sst', 'chl', 'ssh']:
+        stages[variable] = ([], partial(cold, variable), partial(monthly, variable, False))
+        stages[f'{variable}_out_of_core'] = ([], partial(cold, variable), partial(monthly, variable, True))
+    return stages
+
+
+STAGE_ORDER = ['extract_sst', 'extract_chl', 'extract_ssh', 'sst', 'chl', 'ssh',
+               'sst_out_of_core', 'chl_out_of_core', 'ssh_out_of_core', 'area', 'wind', 'covariates',
+               'cc_events', 'cc', 'landings', 'species_stats', 'species', 'prices', 'effort', 'panels']
+
+
+def peak_rss(m, call, interval=0.005):
+    ### (result, peak RSS in MB during call): the kernel high-water mark reset just before the call
+    ### (/proc/self/clear_refs, Linux), else the highest RSS seen by a sampling thread. The stage runs
+    ### once either way, its own errors are never taken for a missing /proc
+    if m.reset_peak_rss():
+        result = call()
+        try:
+            return result, m.peak_rss_mb()
+        except OSError:
+            return result, m.rss_mb()
+
+    peak = [m.rss_mb()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], m.rss_mb())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        result = call()
+    finally:
+        done.set()
+        thread.join()
+    return result, max(peak[0], m.rss_mb())
+
+
+def run_stage(name, root, scale):
+    ### Child process: set up, time one stage, save its result for downstream stages
+    m = load_pipeline(root)
+    os.chdir(root)
+
+    deps, setup, call = stage_table(m, root, scale)[name]
+    upstream = {}
+    for dep in deps:
+        with open(os.path.join('results', f'{dep}.pkl'), 'rb') as f:
+            upstream[dep] = pickle.load(f)
+    ready = setup() if setup else None
+
+    ### Peak is the stage's own, not the import footprint that ru_maxrss never drops below
+    rss0 = m.rss_mb()
+    t0, c0 = time.perf_counter(), time.process_time()
+    result, peak = peak_rss(m, partial(call, upstream, ready))
+    seconds, cpu = time.perf_counter() - t0, time.process_time() - c0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    os.makedirs('results', exist_ok=True)
+    with open(os.path.join('results', f'{name}.pkl'), 'wb') as f:
+        pickle.dump(result, f)
+
+    ### ru_maxrss is in KiB on Linux; stage_rss_mb is the stage's peak over the RSS it started from
+    return {'stage': name, 'seconds': seconds, 'cpu_seconds': cpu,
+            'worker_cpu_seconds': children.ru_utime + children.ru_stime,
+            'setup_rss_mb': rss0, 'peak_rss_mb': peak, 'stage_rss_mb': max(peak - rss0, 0),
+            'peak_worker_rss_mb': children.ru_maxrss / 1024, 'rows': m.count_rows(result), 'ncores': m.NCORES}
+
+
+#%%
+def git_commit():
+    try:
+        head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(PIPELINE),
+                              capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', PIPELINE], cwd=os.path.dirname(PIPELINE),
+                               capture_output=True, text=True).stdout.strip() != ''
+        return head, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def benchmark(root, scale, stages, repeat):
+    ### Each stage in a fresh interpreter so peak RSS belongs to that stage alone
+    make_fixtures(root, scale)
+    results = []
+    for name in stages:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-stage', name, '--root', root,
+                                  '--scale', scale], capture_output=True, text=True)
+            if out.returncode != 0:
+                raise RuntimeError(f"Stage {name} failed:\n{out.stderr[-2000:]}")
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        best = min(runs, key=lambda x: x['seconds'])
+        best = {**best, 'runs': [x['seconds'] for x in runs],
+                'peak_rss_mb': max(x['peak_rss_mb'] for x in runs),
+                'stage_rss_mb': max(x['stage_rss_mb'] for x in runs),
+                'peak_worker_rss_mb': max(x['peak_worker_rss_mb'] for x in runs)}
+        print(f"{name:>18}: {best['seconds']:8.3f}s  +{best['stage_rss_mb']:8.1f} MB", file=sys.stderr)
+        results.append(best)
+
+    commit, dirty = git_commit()
+    return {'commit': commit, 'dirty': dirty, 'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'ncores': results[0]['ncores'] if results else None, 'repeat': repeat,
+            'scale': scale, 'params': SCALES[scale], 'stages': results}
+
+
+def compare(old, new):
+    ### Per-stage wall time and stage RSS (peak over setup) ratios (new / old)
+    old = {x['stage']: x for x in old['stages']}
+    rows = []
+    for x in new['stages']:
+        if x['stage'] in old:
+            y = old[x['stage']]
+            rows.append({'stage': x['stage'], 'old_s': y['seconds'], 'new_s': x['seconds'],
+                         'time_ratio': x['seconds'] / y['seconds'] if y['seconds'] else np.nan,
+                         'old_rss_mb': y['stage_rss_mb'], 'new_rss_mb': x['stage_rss_mb'],
+                         'rss_ratio': x['stage_rss_mb'] / y['stage_rss_mb'] if y['stage_rss_mb'] else np.nan})
+    return pd.DataFrame(rows)
+
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark 1-Data-step.py stages on synthetic inputs")
+    parser.add_argument('--scale', default='small', choices=list(SCALES))
+    parser.add_argument('--root', default=None, help="fixture/work directory (kept and reused when given)")
+    parser.add_argument('--stages', default=','.join(STAGE_ORDER), help="comma-separated stages, in run order")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--out', default=None, help="write the JSON report here (default stdout)")
+    parser.add_argument('--compare', default=None, help="earlier JSON report to compare against")
+    parser.add_argument('--run-stage', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, args.root, args.scale)))
+        sys.exit(0)
+
+    root = os.path.abspath(args.root) if args.root else tempfile.mkdtemp(prefix='pr_bench_')
+    try:
+        report = benchmark(root, args.scale, args.stages.split(','), args.repeat)
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report).to_string(index=False, float_format='%.3f'), file=sys.stderr)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
@@ -0,0 +1,23 @@
+### Shared fixtures: the benchmark's synthetic inputs at the small scale, and the pipeline imported against them
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+
+
+@pytest.fixture(scope='session')
+def fixtures(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('fixtures'))
+    benchmark.make_fixtures(root, 'small')
+    return root
+
+
+@pytest.fixture
+def pipeline(fixtures, tmp_path, monkeypatch):
+    ### Caches, partitions and outputs go to a fresh working directory per test
+    m = benchmark.load_pipeline(fixtures)
+    monkeypatch.chdir(tmp_path)
+    return m
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def proc_cc(start_date, end_date, cc_int, n_region):
+    ### The original per-event expansion (freq='ME' is the current spelling of freq='M')
+    outdat = pd.DataFrame()
+    for region_ in n_region.split(','):
+        region_ = region_.strip()
+        indat = pd.DataFrame({'date': pd.DatetimeIndex(pd.date_range(start_date, end_date, freq='ME').strftime("%Y-%m"))})
+        indat = indat.assign(year = indat.date.dt.year,
+                             month = indat.date.dt.month,
+                             region = region_,
+                             intensity = cc_int)
+        indat = indat[indat['year'] >= 2010]
+        indat = indat.assign(timeSeries = range(1, 1 + len(indat)))
+        outdat = pd.concat([outdat, indat])
+    return outdat
+
+
+EVENTS = pd.DataFrame([
+    ('03/15/2012', '07/02/2012', 'NORTH', -3),            # mid-month start and end
+    ('01/31/2011', '01/31/2011', 'SOUTH', 2),             # starts and ends on a month end
+    ('02/01/2012', '02/28/2012', 'WEST', 4),              # leap February ends after the 28th
+    ('02/01/2012', '02/29/2012', 'WEST', -5),
+    ('11/20/2009', '02/10/2010', 'NORTH, SOUTH', -2),     # starts before 2010, two regions
+    ('06/01/2008', '08/01/2009', 'EAST,WEST', 1),         # entirely before 2010
+    ('05/05/2013', '05/20/2013', 'SOUTH', -4),            # no month end inside the event
+    ('09/30/2014', '09/01/2014', 'NORTH', 3),             # ends before it starts
+    ('12/31/2015', '01/31/2017', ' east , WEST,NORTH', -1),
+], columns=['sdate', 'edate', 'region', 'intensity'])
+
+### Timestamps with a time of day: month ends count at the start's time of day, as pd.date_range does
+TIMED = pd.DataFrame([
+    ('01/31/2011 10:30', '03/31/2011 09:00', 'EAST', -1),
+    ('01/31/2011 08:00', '03/31/2011 09:00', 'EAST', 1),
+    ('04/15/2011 23:59', '06/30/2011 23:59', 'NORTH', -3),
+], columns=['sdate', 'edate', 'region', 'intensity'])
+
+
+def original_ccdat2(ccdat):
+    ccdat2 = ccdat.apply(lambda x: proc_cc(x['sdate'], x['edate'], x['intensity'], x['region']), axis=1)
+    return pd.concat([x for x in ccdat2])
+
+
+def original_ccdat3(ccdat2, threshold=-1):
+    ### The original six filtered groupbys and conflict-first left merge chain
+    ccdat2 = ccdat2.assign(group_1 = np.where(ccdat2['intensity'] <= threshold, 0, 1))
+    tables = []
+    for group, name in [(0, 'conflict'), (1, 'coop')]:
+        sub = ccdat2[ccdat2['group_1'] == group].groupby(['year', 'month', 'region'])
+        tables += [sub['group_1'].count().reset_index().rename(columns={'group_1': f'{name}_count'}),
+                   sub['intensity'].sum().reset_index().rename(columns={'intensity': f'{name}_sum'}),
+                   sub['intensity'].mean().abs().reset_index().rename(columns={'intensity': f'{name}_mean'})]
+    ccdat3 = tables[0]
+    for table in tables[1:]:
+        ccdat3 = ccdat3.merge(table, on=['year', 'month', 'region'], how='left')
+    ccdat3 = ccdat3.assign(cc_ratio_count = ccdat3['conflict_count'] / ccdat3['coop_count'])
+    ccdat3 = ccdat3.assign(cc_ratio_sum = ccdat3['conflict_sum'] / ccdat3['coop_sum'])
+    ccdat3 = ccdat3.assign(cc_ratio_mean = ccdat3['conflict_mean'] / ccdat3['coop_mean'])
+    return ccdat3
+
+
+@pytest.mark.parametrize('events', [EVENTS, TIMED])
+def test_expand_cc_matches_proc_cc(pipeline, events):
+    pd.testing.assert_frame_equal(pipeline.expand_cc(events), original_ccdat2(events), check_dtype=False)
+
+
+def test_expand_cc_matches_proc_cc_on_fixture_events(pipeline, fixtures):
+    ccdat = pd.read_csv(f'{fixtures}/data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv')
+    ccdat = ccdat[['StartDate', 'EndDate', 'DNER_Districts', 'Intensity_Score']]
+    ccdat.columns = ['sdate', 'edate', 'region', 'intensity']
+    pd.testing.assert_frame_equal(pipeline.expand_cc(ccdat), original_ccdat2(ccdat), check_dtype=False)
+
+
+@pytest.mark.parametrize('threshold', [-1, -3, 2])
+def test_aggregate_cc_matches_merge_chain(pipeline, fixtures, threshold):
+    ccdat = pd.read_csv(f'{fixtures}/data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv')
+    ccdat = ccdat[['StartDate', 'EndDate', 'DNER_Districts', 'Intensity_Score']]
+    ccdat.columns = ['sdate', 'edate', 'region', 'intensity']
+    ccdat2 = pd.concat([original_ccdat2(ccdat), original_ccdat2(EVENTS), original_ccdat2(TIMED)])
+
+    expected = original_ccdat3(ccdat2, threshold).sort_values(['year', 'month', 'region']).reset_index(drop=True)
+    result = pipeline.aggregate_cc(ccdat2, threshold=threshold)
+    assert len(result) and result['coop_count'].isna().any()
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
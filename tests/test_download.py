@@ -0,0 +1,127 @@
+### Offline SSH downloader tests against a local stand-in for the PODAAC server (Range requests, .md5 files)
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+GRANULES = {f'ssh_grids_v1812_20100{i}0112.nc': np.random.default_rng(i).bytes(50000 + i) for i in range(1, 4)}
+
+
+@pytest.fixture
+def podaac():
+    ### Serves GRANULES and their .md5 files, honouring Range; requests are recorded as (path, Range header)
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append((self.path, self.headers.get('Range')))
+            name = os.path.basename(self.path)
+            if name.endswith('.md5') and name[:-4] in GRANULES:
+                body = f"{hashlib.md5(GRANULES[name[:-4]]).hexdigest()}  {name[:-4]}\n".encode()
+            elif name in GRANULES:
+                body = GRANULES[name]
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            start = 0
+            if self.headers.get('Range'):
+                start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(body)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body) - start))
+            self.end_headers()
+            self.wfile.write(body[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/cdr_grid', requests
+    server.shutdown()
+
+
+def test_download_file_resumes_with_range(pipeline, podaac, tmp_path):
+    base_url, requests = podaac
+    name, body = next(iter(GRANULES.items()))
+    dest = str(tmp_path / name)
+    with open(dest + '.part', 'wb') as f:
+        f.write(body[:12345])
+
+    info = pipeline.download_file(f'{base_url}/{name}', dest, md5=hashlib.md5(body).hexdigest())
+    assert requests == [(f'/cdr_grid/{name}', 'bytes=12345-')]
+    assert open(dest, 'rb').read() == body and not os.path.exists(dest + '.part')
+    assert info == {'size': len(body), 'md5': hashlib.md5(body).hexdigest()}
+
+
+def test_download_file_complete_partial_gets_416(pipeline, podaac, tmp_path):
+    base_url, requests = podaac
+    name, body = next(iter(GRANULES.items()))
+    dest = str(tmp_path / name)
+    with open(dest + '.part', 'wb') as f:
+        f.write(body)
+
+    info = pipeline.download_file(f'{base_url}/{name}', dest, md5=hashlib.md5(body).hexdigest())
+    assert requests == [(f'/cdr_grid/{name}', f'bytes={len(body)}-')]
+    assert open(dest, 'rb').read() == body and info['size'] == len(body)
+
+
+def test_download_granule_recovers_from_md5_mismatch(pipeline, podaac, tmp_path):
+    ### A corrupt partial is resumed, fails the checksum, is discarded, and the retry fetches the whole file
+    base_url, requests = podaac
+    name, body = next(iter(GRANULES.items()))
+    dest = str(tmp_path / name)
+    with open(dest + '.part', 'wb') as f:
+        f.write(bytes(x ^ 0xff for x in body[:1000]))
+
+    with pytest.raises(IOError, match='md5'):
+        pipeline.download_file(f'{base_url}/{name}', dest, md5=hashlib.md5(body).hexdigest())
+    assert not os.path.exists(dest + '.part') and not os.path.exists(dest)
+
+    with open(dest + '.part', 'wb') as f:
+        f.write(bytes(x ^ 0xff for x in body[:1000]))
+    requests.clear()
+    info = pipeline.download_granule(name, str(tmp_path), base_url=base_url, backoff=0)
+    assert requests == [(f'/cdr_grid/{name}.md5', None), (f'/cdr_grid/{name}', 'bytes=1000-'), (f'/cdr_grid/{name}', None)]
+    assert open(dest, 'rb').read() == body and info['md5'] == hashlib.md5(body).hexdigest()
+
+
+def test_download_ssh_data_skips_manifest_entries(pipeline, podaac, tmp_path):
+    base_url, requests = podaac
+    out_dir = str(tmp_path / 'ssh')
+    files = sorted(GRANULES) + ['ssh_grids_v1812_2010120112.nc']
+
+    failed = pipeline.download_ssh_data(out_dir, connections=2, files=files, base_url=base_url)
+    assert list(failed) == [files[-1]] and '404' in failed[files[-1]]
+    assert sum(x == f'/cdr_grid/{files[-1]}' for x, _ in requests) == 1
+    with open(os.path.join(out_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    assert manifest == {x: {'size': len(y), 'md5': hashlib.md5(y).hexdigest()} for x, y in GRANULES.items()}
+    for name, body in GRANULES.items():
+        assert open(os.path.join(out_dir, name), 'rb').read() == body
+
+    ### Second run fetches only what is missing: the failed granule, a deleted one and a truncated one
+    os.remove(os.path.join(out_dir, files[0]))
+    with open(os.path.join(out_dir, files[1]), 'r+b') as f:
+        f.truncate(100)
+    requests.clear()
+    failed = pipeline.download_ssh_data(out_dir, connections=2, files=files, base_url=base_url)
+    assert list(failed) == [files[-1]]
+    assert {os.path.basename(x) for x, _ in requests if not x.endswith('.md5')} == {files[0], files[1], files[-1]}
+    for name, body in GRANULES.items():
+        assert open(os.path.join(out_dir, name), 'rb').read() == body
@@ -0,0 +1,68 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+
+def original_get_sst(file_loc, region, region_coords):
+    ### The original extractor: whole file to_dataframe, then one box mask per region
+    ds = xr.open_dataset(file_loc)
+    df = ds.to_dataframe().reset_index()
+
+    df.loc[:, 'lon'] = np.where(df['lon'] > 180, -360 + df['lon'], df['lon'])
+
+    df = df[(df['lat'] >= region_coords[1]) & (df['lat'] <= region_coords[3])]
+    df = df[(df['lon'] >= region_coords[0]) & (df['lon'] <= region_coords[2])]
+
+    df = df.assign(date = df['time'], region = region)
+    df = df[['date', 'region', 'lon', 'lat', 'sst']]
+    return df
+
+
+def original_get_chl(file_, north_region, south_region, east_region, west_region):
+    ### The original extractor, printing dropped
+    year_day = os.path.splitext(os.path.basename(file_))[0].split('.')[0][-7:8]
+    year = year_day[-7:4]
+    day = year_day[5:8]
+    month =  pd.to_datetime(year_day, format="%Y%j").month
+
+    ds = xr.open_dataset(file_, drop_variables=['palette'])
+    df = ds.to_dataframe().reset_index()
+
+    outdat = []
+    for name, region in [('North', north_region), ('South', south_region), ('East', east_region), ('West', west_region)]:
+        rdf = df[(df['lat'] >= region[1]) & (df['lat'] <= region[3])]
+        rdf = rdf[(rdf['lon'] >= region[0]) & (rdf['lon'] <= region[2])]
+        outdat.append(rdf.assign(region = name, year = year, month=month, day=day))
+    return pd.concat(outdat).reset_index(drop=True)
+
+
+def by_region(df, region):
+    return df[df['region'] == region].drop(columns='weight', errors='ignore').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('i', [0, -1])
+def test_get_sst_matches_original(pipeline, fixtures, i):
+    file_ = sorted(glob.glob(f'{fixtures}/grid/sst/*.nc'))[i]
+    result = pipeline.get_sst(file_)
+    assert (result['weight'] > 0).all()
+    for region, coords in pipeline.REGIONS.items():
+        expected = original_get_sst(file_, region, coords).reset_index(drop=True)
+        assert len(expected) > 0
+        pd.testing.assert_frame_equal(by_region(result, region), expected)
+
+
+@pytest.mark.parametrize('i', [0, -1])
+def test_get_chl_matches_original(pipeline, fixtures, i):
+    file_ = sorted(glob.glob(f'{fixtures}/grid/chl/*.nc'))[i]
+    m = pipeline
+    result = m.get_chl(file_)
+    expected = original_get_chl(file_, m.North, m.South, m.East, m.West)
+    assert len(result) == len(expected)
+    for region in m.REGIONS:
+        rows = by_region(expected, region)
+        assert len(rows) > 0
+        pd.testing.assert_frame_equal(by_region(result, region)[list(rows.columns)], rows)
@@ -0,0 +1,19 @@
+import pandas as pd
+
+
+def test_landings_with_blank_counts(pipeline, fixtures, tmp_path):
+    ### Blank trips/fishers cells load as NA and the species sums match the untyped read (NaN skipped)
+    efdat = pd.read_csv(f'{fixtures}/data/PR_nonconf_landings_2010_19_2021-01-07.CSV')
+    efdat.loc[efdat.index[::7], 'trips'] = None
+    efdat.loc[efdat.index[::11], 'fishers'] = None
+    path = str(tmp_path / 'landings.csv')
+    efdat.to_csv(path, index=False)
+
+    typed = pipeline.load_landings(path, cache_dir='landings')
+    assert typed['trips'].isna().sum() == efdat['trips'].isna().sum()
+    pd.testing.assert_frame_equal(pipeline.load_landings(path, cache_dir='landings'), typed)
+
+    stats = pipeline.species_stats(typed)
+    expected = efdat.groupby(['ITIS_COMMON_NAME', 'YEAR_LANDED'])[['trips', 'fishers']].sum().reset_index()
+    assert stats[['trips', 'fishers']].notna().all().all()
+    pd.testing.assert_frame_equal(stats[['trips', 'fishers']].astype('float64'), expected[['trips', 'fishers']])
@@ -0,0 +1,72 @@
+import glob
+import os
+import shutil
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+
+def test_monthly_moments_match_groupby_with_empty_file(pipeline, fixtures, tmp_path):
+    ### A fully clouded CHL day (no valid pixels) must not turn the month's mean/var into NaN
+    files = []
+    for i, file_ in enumerate(sorted(glob.glob(f'{fixtures}/grid/chl/*.nc'))):
+        dest = str(tmp_path / os.path.basename(file_))
+        if i == 1:
+            with xr.open_dataset(file_) as ds:
+                ds.load().assign(chlor_a = ds['chlor_a'] * np.nan).to_netcdf(dest)
+        else:
+            shutil.copy(file_, dest)
+        files.append(dest)
+    pipeline.GRIDDED['chl'] = str(tmp_path / '*.nc')
+
+    streamed = pipeline.env_monthly('chl', pipeline.REGIONS, 2010, weighted=False, out_of_core=False)
+
+    daily = pd.concat([pipeline.get_chl(x) for x in files])
+    daily = daily.assign(year = daily['year'].astype(int), month = daily['month'].astype(int),
+                         chlor_a = daily['chlor_a'].astype('float64'))
+    expected = daily.groupby(['year', 'month', 'region'])['chlor_a'].agg(['mean', 'var']).reset_index()
+
+    streamed = streamed.merge(expected, on=['year', 'month', 'region'], how='outer')
+    assert len(streamed) == len(expected) == 4
+    assert streamed['chlor_a_mean'].notna().all()
+    np.testing.assert_allclose(streamed['chlor_a_mean'], streamed['mean'], rtol=1e-9)
+    np.testing.assert_allclose(streamed['chlor_a_var'], streamed['var'], rtol=1e-9)
+
+
+def test_merge_moments_empty_side(pipeline):
+    ### Merging with a group that has no valid values leaves the other side unchanged, in either order
+    values = ['x']
+    full = pipeline.moments(pd.DataFrame({'g': [1, 1, 1, 2, 2], 'x': [1.0, 2.0, 4.0, 3.0, np.nan]}), ['g'], values)
+    empty = pipeline.moments(pd.DataFrame({'g': [1, 2], 'x': [np.nan, np.nan]}), ['g'], values)
+    for merged in [pipeline.merge_moments(full, empty, values), pipeline.merge_moments(empty, full, values)]:
+        pd.testing.assert_frame_equal(merged, full, check_dtype=False)
+
+
+@pytest.mark.parametrize('out_of_core', [False, True])
+def test_monthly_moments_no_files(pipeline, tmp_path, out_of_core):
+    ### An empty glob names the variable and the pattern instead of failing inside the fold
+    pipeline.GRIDDED['chl'] = str(tmp_path / 'missing' / '*.nc')
+    with pytest.raises(FileNotFoundError, match="chl.*missing"):
+        pipeline.env_monthly('chl', pipeline.REGIONS, 2010, weighted=False, out_of_core=out_of_core)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('variable', ['sst', 'chl', 'ssh'])
+def test_archive_moments_match_file_moments(pipeline, variable, weighted):
+    ### The lazy whole-archive reduction gives the same monthly mean/var as folding per-file moments
+    values = {'sst': ['sst'], 'chl': ['chlor_a'], 'ssh': ['sla', 'sla_err']}[variable]
+    extract = {'sst': pipeline.get_sst, 'chl': pipeline.get_chl, 'ssh': pipeline.get_ssh}[variable]
+    weight = 'weight' if weighted else None
+    keys = ['year', 'month', 'region']
+
+    streamed = pipeline.proc_monthly(variable, partial(extract, regions=pipeline.REGIONS), values, ncores=1, weight=weight)
+    archived = pipeline.finalize_moments(pipeline.archive_moments(variable, pipeline.REGIONS, weight, ncores=1), values)
+
+    merged = streamed.merge(archived, on=keys, how='outer', suffixes=('', '_archive'))
+    assert len(merged) == len(streamed) == len(archived) > 0
+    for x in values:
+        for stat in ['mean', 'var']:
+            np.testing.assert_allclose(merged[f'{x}_{stat}_archive'], merged[f'{x}_{stat}'], rtol=1e-9)
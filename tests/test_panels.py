@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+KEYS = ['year', 'month', 'region']
+
+
+def original_panel(efdat3, cc, sst, chl, wind, ssh, hurr, noi, area_df):
+    ### The original left-merge chain shared by regdat and mregdat
+    regdat = efdat3.merge(cc, on=KEYS, how='left')
+    for table in [sst, chl, wind, ssh, hurr]:
+        regdat = regdat.merge(table, on=KEYS, how='left')
+    regdat = regdat.merge(noi, on=['year', 'month'], how='left')
+    regdat = regdat.merge(area_df, on=['region'], how='left')
+    regdat['hurricane'] = regdat.hurricane.fillna(0)
+    return regdat.dropna()
+
+
+def monthly(rng, name, regions, years, frac=0.9):
+    ### A covariate table over a random subset of the (year, month, region) grid
+    grid = pd.MultiIndex.from_product([years, range(1, 13), regions], names=KEYS).to_frame(index=False)
+    grid = grid.sample(frac=frac, random_state=int(rng.integers(1 << 30))).reset_index(drop=True)
+    return grid.assign(**{f'{name}_mean': rng.normal(size=len(grid)), f'{name}_var': rng.random(len(grid))})
+
+
+def test_assemble_panels_matches_merge_chains(pipeline, fixtures):
+    rng = np.random.default_rng(3)
+    regions = ['North', 'South', 'East', 'West']
+    years = range(2010, 2014)
+
+    ccdat = pd.read_csv(f'{fixtures}/data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv')
+    ccdat = ccdat[['StartDate', 'EndDate', 'DNER_Districts', 'Intensity_Score']]
+    ccdat.columns = ['sdate', 'edate', 'region', 'intensity']
+    ccdat3, main_ccdat2 = pipeline.cc_tables(pipeline.expand_cc(ccdat), threshold=-1)
+
+    ### Effort rows include a region no covariate covers and years the covariates partly miss
+    efdat3 = monthly(rng, 'pounds', regions + ['Culebra'], range(2010, 2015), frac=0.8)
+    efdat3 = efdat3.rename(columns={'pounds_mean': 'pounds', 'pounds_var': 'price'}).assign(trips = rng.integers(1, 50, len(efdat3)))
+    sst, chl, wind, ssh = [monthly(rng, x, regions, years) for x in ['sst', 'chlor_a', 'wspd', 'sla']]
+    hurr = monthly(rng, 'x', regions, years, frac=0.1)[KEYS].assign(hurricane = 1)
+    noi = pd.MultiIndex.from_product([range(2009, 2015), range(1, 13)], names=['year', 'month']).to_frame(index=False)
+    noi = noi.assign(noi = rng.normal(size=len(noi)))
+    area_df = pd.DataFrame({'region': regions + ['Vieques'], 'area': rng.random(5)})
+
+    covariates = [(sst, KEYS), (chl, KEYS), (wind, KEYS), (ssh, KEYS), (hurr, KEYS), (noi, ['year', 'month']), (area_df, ['region'])]
+    regdat, mregdat = pipeline.build_panels(efdat3, (ccdat3, main_ccdat2), covariates)
+
+    expected = original_panel(efdat3, ccdat3, sst, chl, wind, ssh, hurr, noi, area_df)
+    assert len(regdat) and len(regdat) < len(efdat3)
+    pd.testing.assert_frame_equal(regdat, expected, check_dtype=False)
+
+    expected = original_panel(efdat3, main_ccdat2, sst, chl, wind, ssh, hurr, noi, area_df)
+    assert len(mregdat) > len(regdat)
+    pd.testing.assert_frame_equal(mregdat, expected, check_dtype=False)
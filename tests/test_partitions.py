@@ -0,0 +1,57 @@
+import os
+
+import pandas as pd
+
+_original = {}
+
+
+def get_chl(file_, regions=None):
+    ### Same name as the pipeline's extractor, different code: doubles chlor_a
+    df = _original['get_chl'](file_, regions)
+    return df.assign(chlor_a = df['chlor_a'] * 2)
+
+
+def test_resume_respects_task(pipeline):
+    ### Partitions built for other regions are redone, not reused
+    os.makedirs('data')
+    pipeline.proc_sst(regions={'North': pipeline.North})
+    assert set(pd.read_csv(pipeline.DAILY['sst'][0])['region']) == {'North'}
+
+    pipeline.proc_sst(regions=pipeline.REGIONS)
+    assert set(pd.read_csv(pipeline.DAILY['sst'][0])['region']) == set(pipeline.REGIONS)
+
+    ### Same task again: every partition is reused
+    mtimes = {x: os.path.getmtime(os.path.join('data/partitions/sst', x)) for x in os.listdir('data/partitions/sst')}
+    pipeline.proc_sst(regions=pipeline.REGIONS)
+    assert mtimes == {x: os.path.getmtime(os.path.join('data/partitions/sst', x)) for x in os.listdir('data/partitions/sst')}
+
+
+def test_monthly_partitions_follow_extractor_code(pipeline, monkeypatch):
+    ### A changed extractor (or a setting it reads) must not be served its old moments
+    before = pipeline.env_monthly('chl', pipeline.REGIONS, 2010, weighted=False, out_of_core=False)
+
+    _original['get_chl'] = pipeline.get_chl
+    monkeypatch.setattr(pipeline, 'get_chl', get_chl)
+    after = pipeline.env_monthly('chl', pipeline.REGIONS, 2010, weighted=False, out_of_core=False)
+    pd.testing.assert_series_equal(after['chlor_a_mean'], before['chlor_a_mean'] * 2, rtol=1e-6)
+
+    task = pipeline.task_digest(pipeline.partial(pipeline.file_moments, extract=pipeline.get_sst, values=['sst']))
+    monkeypatch.setattr(pipeline, 'EARTH_RADIUS', 6371.0)
+    assert pipeline.task_digest(pipeline.partial(pipeline.file_moments, extract=pipeline.get_sst, values=['sst'])) != task
+
+
+def test_file_format_set_at_runtime(pipeline, monkeypatch):
+    ### Switching FILE_FORMAT after import reaches partitions and daily tables, which use fmt=None
+    os.makedirs('data')
+    pipeline.proc_sst(regions=pipeline.REGIONS)
+    csv = pipeline.read_daily('sst')
+
+    monkeypatch.setattr(pipeline, 'FILE_FORMAT', 'parquet')
+    pipeline.proc_sst(regions=pipeline.REGIONS)
+    assert any(x.endswith('.parquet') for x in os.listdir('data/partitions/sst'))
+    assert pipeline.daily_files('sst') and all(x.endswith('.parquet') for x in pipeline.daily_files('sst'))
+
+    parquet = pipeline.read_daily('sst')
+    keys = ['year', 'month', 'region', 'sst']
+    pd.testing.assert_frame_equal(parquet.sort_values(keys).reset_index(drop=True)[keys],
+                                  csv.sort_values(keys).reset_index(drop=True)[keys], check_dtype=False)
@@ -0,0 +1,62 @@
+import glob
+import multiprocessing
+
+import numpy as np
+import xarray as xr
+
+_worker = {}
+
+
+def _start(pipeline, barrier):
+    _worker.update(pipeline=pipeline, barrier=barrier)
+
+
+def _build(lats, lons, cache_dir):
+    ### All workers write the cold index at the same moment
+    _worker['barrier'].wait()
+    m = _worker['pipeline']
+    return m.region_index(lats, lons, m.REGIONS, cache_dir)
+
+
+def test_region_index_concurrent_cold_cache(pipeline, fixtures):
+    ### Every worker builds and writes the same index at once, none may fail or read a partial file
+    with xr.open_dataset(sorted(glob.glob(f'{fixtures}/grid/chl/*.nc'))[0]) as ds:
+        lats, lons = ds['lat'].values, ds['lon'].values
+
+    results = []
+    ctx = multiprocessing.get_context('fork')
+    for attempt in range(20):
+        ### Forked workers must not inherit an in-memory index
+        pipeline._region_indexes.clear()
+        with ctx.Pool(4, initializer=_start, initargs=(pipeline, ctx.Barrier(4))) as pool:
+            results += pool.starmap(_build, [(lats, lons, f'cold{attempt}')] * 4)
+
+    expected = pipeline.region_index(lats, lons, pipeline.REGIONS, cache_dir='expected')
+    for index in results:
+        for region, cells in expected.items():
+            for x, y in zip(index[region], cells):
+                np.testing.assert_array_equal(x, y)
+
+
+def test_region_index_reload_in_other_order(pipeline, fixtures):
+    ### The cached index serves the same regions listed in any order, each with its own cells
+    with xr.open_dataset(sorted(glob.glob(f'{fixtures}/grid/chl/*.nc'))[0]) as ds:
+        lats, lons = ds['lat'].values, ds['lon'].values
+
+    expected = pipeline.region_index(lats, lons, pipeline.REGIONS, cache_dir='index')
+    pipeline._region_indexes.clear()
+    reloaded = pipeline.region_index(lats, lons, dict(reversed(pipeline.REGIONS.items())), cache_dir='index')
+    assert len(glob.glob('index/*.npz')) == 1
+    for region, cells in expected.items():
+        for x, y in zip(reloaded[region], cells):
+            np.testing.assert_array_equal(x, y)
+
+
+def test_region_index_weights_across_dateline(pipeline):
+    ### A 0-360 grid read as -180 - 180 jumps at the seam; cells next to it keep their 1 degree width
+    lats = np.arange(-4.5, 5)
+    lons = np.arange(0.5, 360)
+    index = pipeline.region_index(lats, lons, {'Seam': [177, -2, 180, 2], 'Other': [-180, -2, -177, 2]}, cache_dir='index')
+    flat = pipeline.region_index(lats, lons, {'Flat': [10, -2, 13, 2]}, cache_dir='index')
+    for region in ['Seam', 'Other']:
+        np.testing.assert_allclose(np.sort(index[region][2]), np.sort(flat['Flat'][2]))
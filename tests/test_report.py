@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import benchmark
+
+
+def allocate(mb):
+    return np.ones(int(mb) * 2 ** 17).sum()
+
+
+def test_probed_per_file_memory(pipeline):
+    ### Each file's own peak, not the process's lifetime high-water mark
+    if not pipeline.reset_peak_rss():
+        pytest.skip('/proc/self/clear_refs is not writable here')
+    _, big = pipeline.probed(allocate, '200')
+    _, small = pipeline.probed(allocate, '10')
+    assert big['rss_delta_mb'] > 150
+    assert small['rss_delta_mb'] < 50
+    assert small['peak_rss_mb'] < big['peak_rss_mb']
+    assert small['bytes_read'] is not None
+
+
+def test_probed_threads_leave_process_counters_empty(pipeline):
+    with ThreadPoolExecutor(2) as pool:
+        _, record = pool.submit(pipeline.probed, allocate, '10').result()
+    assert record['peak_rss_mb'] is None and record['rss_delta_mb'] is None and record['bytes_read'] is None
+    assert record['seconds'] > 0
+
+
+@pytest.mark.parametrize('clear_refs', [True, False])
+def test_benchmark_stage_errors_run_once(pipeline, monkeypatch, clear_refs):
+    ### A stage's own OSError propagates from its single run, with or without the kernel high-water mark
+    if not clear_refs:
+        monkeypatch.setattr(pipeline, 'reset_peak_rss', lambda: False)
+    calls = []
+
+    def stage():
+        calls.append(1)
+        raise FileNotFoundError('missing input')
+
+    with pytest.raises(FileNotFoundError):
+        benchmark.peak_rss(pipeline, stage)
+    assert len(calls) == 1
+    assert benchmark.peak_rss(pipeline, lambda: 'ok')[0] == 'ok'
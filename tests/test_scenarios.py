@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def covariates(pipeline, fixtures):
+    ### Synthetic monthly covariates in place of the gridded stages, with the fixtures' hurricane and NOI tables
+    rng = np.random.default_rng(7)
+    grid = pd.MultiIndex.from_product([[2010], range(1, 13), ['North', 'South', 'East', 'West']],
+                                      names=['year', 'month', 'region']).to_frame(index=False)
+    sst, chl, wind, ssh = [grid.assign(**{x: rng.normal(size=len(grid))}) for x in ['sst', 'chlor_a', 'wspd', 'sla']]
+    area_df = pd.DataFrame({'region': ['North', 'South', 'East', 'West'], 'area': rng.random(4)})
+    return pipeline.covariate_tables(f'{fixtures}/data/hurricanes_138km.csv', f'{fixtures}/data/NOI_Index.csv',
+                                     sst, chl, wind, ssh, area_df)
+
+
+def single_run(pipeline, fixtures, efdat, stats, pricedat, covariates, threshold, min_intensity=None):
+    ### The single-run stage chain at the given settings
+    events = pipeline.load_cc(f'{fixtures}/data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv', pipeline.START_YEAR)
+    if min_intensity is not None:
+        events = events[events['intensity'].abs() >= min_intensity]
+    species = pipeline.species_tables(stats, pipeline.N_SPECIES)[0]
+    efdat3 = pipeline.build_effort(f'{fixtures}/data/Municipalities_by_region_Puerto_Rico_wideFormat.csv', efdat,
+                                   (species,), pricedat)
+    return pipeline.build_panels(efdat3, pipeline.cc_tables(events, threshold), covariates)
+
+
+def roundtrip(df, path):
+    df.to_csv(path, index=False)
+    return pd.read_csv(path)
+
+
+def test_scenario_grid_matches_single_runs(pipeline, fixtures, tmp_path):
+    cc_file = f'{fixtures}/data/FCCE_Master_Intensity_Expanded_zeros_excluded.csv'
+    municipalities = f'{fixtures}/data/Municipalities_by_region_Puerto_Rico_wideFormat.csv'
+    efdat = pipeline.load_landings(f'{fixtures}/data/PR_nonconf_landings_2010_19_2021-01-07.CSV', cache_dir=None)
+    stats = pipeline.species_stats(efdat)
+    pricedat = pipeline.clean_prices(f'{fixtures}/data/PR_Fish_Species_Prices_2010_2018.csv')
+    covs = covariates(pipeline, fixtures)
+
+    grid = {'cc_file': [cc_file], 'threshold': [pipeline.CC_THRESHOLD, -3], 'min_intensity': [None, 3]}
+    index = pipeline.run_scenarios(grid, covs, efdat, stats, pricedat, municipalities, out_dir='scenarios', ncores=2)
+    assert len(index) == 4 and sorted(os.listdir('scenarios')) == sorted(index['scenario'].tolist() + ['scenarios.csv'])
+    assert pd.read_csv('scenarios/scenarios.csv')['scenario'].tolist() == index['scenario'].tolist()
+
+    for threshold, min_intensity in [(pipeline.CC_THRESHOLD, None), (-3, 3)]:
+        scenario = {**pipeline.scenario_grid({})[0], 'cc_file': cc_file, 'threshold': threshold, 'min_intensity': min_intensity}
+        path = os.path.join('scenarios', pipeline.scenario_name(scenario))
+        regdat, mregdat = single_run(pipeline, fixtures, efdat, stats, pricedat, covs, threshold, min_intensity)
+        assert len(regdat) and len(mregdat) > len(regdat)
+        pd.testing.assert_frame_equal(pd.read_csv(f'{path}/FULL_PR_regdat_monthly.csv'), roundtrip(regdat, tmp_path / 'full.csv'))
+        pd.testing.assert_frame_equal(pd.read_csv(f'{path}/UNAGG_PR_regdat_monthly.csv'), roundtrip(mregdat, tmp_path / 'unagg.csv'))
+
+    ### The settings differ in what they keep
+    assert index['rows_unagg'].nunique() > 1
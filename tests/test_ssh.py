@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def previous_get_ssh(pipeline, file_):
+    ### The extractor before the compact rewrite: long table, per-row date decode, full-row drop_duplicates
+    with xr.open_dataset(file_) as ds:
+        df = pipeline.extract_regions(ds, ['SLA', 'SLA_ERR'], pipeline.REGIONS, lat='Latitude', lon='Longitude')
+
+    df = df[['Time', 'Latitude', 'Longitude', 'SLA', 'SLA_ERR', 'weight', 'region']]
+    df = df.rename(columns={'Time': 'date', 'Latitude': 'lat', 'Longitude': 'lon', 'SLA': 'sla', 'SLA_ERR': 'sla_err'})
+    df = df.dropna()
+
+    date = pd.to_datetime(df.date)
+    outdat = df.assign(year = date.dt.year, month = date.dt.month, day = date.dt.day)
+    outdat = outdat.reset_index(drop=True)
+    outdat = outdat.assign(date = outdat['date'].dt.normalize())
+    outdat = outdat.drop_duplicates()
+    return outdat
+
+
+def test_get_ssh_matches_previous_extractor_with_same_day_steps(pipeline, tmp_path):
+    ### PODAAC layout (Time, Longitude, Latitude) with two timestamps on one day: the second repeats the first
+    ### on most cells and differs on the rest, so only the exact repeats are duplicates
+    rng = np.random.default_rng(5)
+    lat = np.arange(16.125, 20, 0.25)
+    lon = np.arange(290.125, 297, 0.25)
+    time_ = pd.to_datetime(['2012-02-28 00:00', '2012-02-28 12:00', '2012-02-29 00:00'])
+    sla = rng.normal(0, 0.1, (3, len(lon), len(lat))).astype('float32')
+    same = rng.random((len(lon), len(lat))) < 0.7
+    sla[1][same] = sla[0][same]
+    sla[:, ::5, ::3] = np.nan
+    sla[0, 1, 1] = -0.0
+    sla[1, 1, 1] = 0.0
+    file_ = str(tmp_path / 'ssh_grids_v1812_2012022812.nc')
+    xr.Dataset({'SLA': (('Time', 'Longitude', 'Latitude'), sla),
+                'SLA_ERR': (('Time', 'Longitude', 'Latitude'), np.abs(sla) / 3)},
+               coords={'Time': time_, 'Latitude': lat, 'Longitude': lon}).to_netcdf(file_)
+
+    expected = previous_get_ssh(pipeline, file_).reset_index(drop=True)
+    result = pipeline.get_ssh(file_)
+    assert (expected['day'] == 29).sum() < (expected['day'] == 28).sum() < 2 * (expected['day'] == 29).sum()
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert result['sla'].dtype == 'float32'
@@ -0,0 +1,95 @@
+import glob
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+import benchmark
+
+
+def test_stage_key_covers_helpers_and_settings(pipeline, monkeypatch):
+    stages = pipeline.StageGraph('stages')
+    key = lambda func, **params: stages.stage_key('x', func, [], [], [], [], params)
+
+    code, settings = pipeline.code_closure([pipeline.env_monthly])
+    assert {'cell_spacing', 'in_polygon', 'region_geometry', 'gather_cells', 'read_cells', 'SubsetCache',
+            'add_day', 'get_ssh'} <= set(code)
+    assert {'STREAM_MONTHLY', 'ARCHIVES', 'EARTH_RADIUS'} <= set(settings)
+    assert not {'NCORES', 'REPORT', 'SUBSET_CACHE_MB'} & set(settings)
+    assert {'encode_keys', 'index_covariates', 'gather_covariates'} <= set(pipeline.code_closure([pipeline.build_panels])[0])
+
+    ### Result-affecting switches change the key, run-time ones do not
+    before = key(pipeline.env_monthly, variable='sst')
+    monkeypatch.setattr(pipeline, 'NCORES', pipeline.NCORES + 1)
+    assert key(pipeline.env_monthly, variable='sst') == before
+    monkeypatch.setattr(pipeline, 'STREAM_MONTHLY', not pipeline.STREAM_MONTHLY)
+    assert key(pipeline.env_monthly, variable='sst') != before
+
+
+def test_incomplete_stage_is_not_cached(pipeline):
+    ### Same key each time; the incomplete first value is rerun, the complete second one is reused
+    stages = pipeline.StageGraph('stages')
+    calls = []
+    for complete in [False, True, True]:
+        stages.run('s', lambda: calls.append(complete) or complete, complete=bool)
+    assert calls == [False, True]
+
+
+def test_wind_complete_only_with_missing_buoys(pipeline):
+    os.makedirs('data')
+    failures = lambda errors: pd.DataFrame({'buoy_id': 'x', 'error': errors}).to_csv(pipeline.WIND_FAILURES, index=False)
+    failures([])
+    assert pipeline.wind_complete(None)
+    failures(['HTTP 404', 'HTTP 404 (cached)'])
+    assert pipeline.wind_complete(None)
+    failures(['HTTP 404', 'HTTP 503'])
+    assert not pipeline.wind_complete(None)
+
+
+def test_daily_files_for_stamps(pipeline):
+    assert pipeline.daily_files('sst', fmt='csv') == []
+    os.makedirs('data')
+    pd.DataFrame({'x': [1]}).to_csv(pipeline.DAILY['sst'][0])
+    assert pipeline.daily_files('sst', fmt='csv') == [pipeline.DAILY['sst'][0]]
+
+
+def test_superseded_stage_outputs_are_removed(pipeline):
+    ### A new key replaces the stage's old pickle and the input's digest memo; other stages are kept
+    stages = pipeline.StageGraph('stages')
+    with open('input.csv', 'w') as f:
+        f.write('x\n1\n')
+    stages.run('other', lambda: 0)
+    stages.run('s', lambda path, n: n, inputs=['input.csv'], n=1)
+    stages.run('s', lambda path, n: n, inputs=['input.csv'], n=2)
+    with open('input.csv', 'a') as f:
+        f.write('2\n')
+    assert stages.run('s', lambda path, n: n, inputs=['input.csv'], n=2) == 2
+
+    assert sorted(x.split('-')[0] for x in os.listdir('stages') if x.endswith('.pkl')) == ['other', 's']
+    assert os.path.join('stages', f"s-{stages.keys['s']}.pkl") in glob.glob('stages/s-*.pkl')
+    assert len(os.listdir('stages/files')) == 1
+
+
+def test_stages_run_from_interactive_cells(fixtures, tmp_path, monkeypatch):
+    ### Cells run one by one in an interactive window: classes defined there have no source file
+    interactiveshell = pytest.importorskip('IPython.core.interactiveshell')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(sys.modules, '__main__', sys.modules['__main__'])
+    with open(benchmark.PIPELINE) as f:
+        cells = [x for x in f.read().split('#%%') if '__name__ == "__main__"' not in x]
+
+    shell = interactiveshell.InteractiveShell.instance()
+    try:
+        for cell in cells:
+            shell.run_cell(cell).raise_error()
+        shell.run_cell(f"""
+GRIDDED.update({{x: '{fixtures}/grid/' + x + '/*.nc' for x in ['sst', 'chl', 'ssh']}})
+gridded_files = lambda variable: sorted(glob.glob(GRIDDED[variable]))
+stages = StageGraph('stages')
+result = stages.run('sst', env_monthly, variable='sst', regions=REGIONS, start_year=2010)
+""").raise_error()
+        assert len(shell.user_ns['result']) > 0
+        assert 'SubsetCache' in shell.user_ns['code_closure']([shell.user_ns['env_monthly']])[0]
+    finally:
+        interactiveshell.InteractiveShell.clear_instance()
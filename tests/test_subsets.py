@@ -0,0 +1,39 @@
+import glob
+import os
+
+import numpy as np
+
+
+def entry(n, seed):
+    return {'cells': np.arange(n), 'x': np.random.default_rng(seed).random(n).astype('float32')}
+
+
+def test_subset_cache_limits_without_rescanning(pipeline, monkeypatch):
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(pipeline.os, 'scandir', lambda path: scans.append(path) or scandir(path))
+
+    cache = pipeline.SubsetCache('subsets', max_mb=0.5, memory_mb=0.3, rescan_every=50)
+    for i in range(120):
+        cache.put(f'k{i}', entry(10000, i))
+        assert cache.memory_total == sum(sum(x.nbytes for x in y.values()) for y in cache.memory.values())
+        assert cache.memory_total <= cache.memory_bytes
+
+    ### One scan on the first put and one every 50 puts after it, however many files were evicted
+    on_disk = sum(x.stat().st_size for x in scandir('subsets'))
+    assert on_disk <= cache.max_bytes and cache.disk_total == on_disk
+    assert len(scans) == 3
+
+    ### Least recently used entries went first; the newest are still served
+    assert cache.get('k119') is not None and cache.get('k0') is None
+    np.testing.assert_array_equal(cache.get('k119')['x'], entry(10000, 119)['x'])
+
+
+def test_subset_cache_region_without_cells(pipeline, fixtures):
+    ### A box smaller than the 1 degree fixture grid holds no cell centre: no rows, cached or not
+    file_ = sorted(glob.glob(f'{fixtures}/grid/sst/*.nc'))[0]
+    culebra = {'Culebra': [-65.35, 18.27, -65.22, 18.34]}
+    assert len(pipeline.get_sst(file_, culebra)) == 0
+
+    pipeline.SUBSET_CACHE = None
+    assert len(pipeline.get_sst(file_, culebra)) == 0
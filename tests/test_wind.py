@@ -0,0 +1,81 @@
+### Offline NDBC tests against the benchmark's local stand-in server
+import http.server
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+import benchmark
+
+
+@pytest.fixture
+def ndbc_url():
+    return benchmark.serve_ndbc(days=30)
+
+
+def test_fetch_wind_reports_missing_and_parses_old_format(pipeline, ndbc_url):
+    tasks = [('sjnp4', 2010, 'North'), (benchmark.MISSING_BUOY, 2010, 'North'), (benchmark.OLD_FORMAT_BUOY, 2010, 'South')]
+    wind, failures = pipeline.fetch_wind(tasks, base_url=ndbc_url, cache_dir='ndbc')
+
+    assert failures[['buoy_id', 'year', 'region', 'attempts', 'error']].values.tolist() == \
+        [[benchmark.MISSING_BUOY, 2010, 'North', 1, 'HTTP 404']]
+    assert wind.groupby('buoy_id').size().to_dict() == {'sjnp4': 30, benchmark.OLD_FORMAT_BUOY: 30}
+    assert wind['WSPD'].between(0, 12).all() and wind['WDIR'].between(0, 360).all()
+
+    ### Rerun from the cache, the 404 included, gives the same result without the server
+    again, failures_again = pipeline.fetch_wind(tasks, base_url=ndbc_url, cache_dir='ndbc')
+    pd.testing.assert_frame_equal(wind, again)
+    assert failures_again['error'].tolist() == ['HTTP 404 (cached)']
+
+
+def test_fetch_url_retries_server_errors(pipeline):
+    hits = []
+
+    class Flaky(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            self.send_response(503 if len(hits) < 3 else 200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Flaky)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/x'
+    try:
+        assert pipeline.fetch_url(url, backoff=0.01) == b'ok'
+        assert len(hits) == 3
+
+        hits.clear()
+        with pytest.raises(pipeline.FetchError) as e:
+            pipeline.fetch_url(url, retries=2, backoff=0.01)
+        assert e.value.attempts == 2 and e.value.reason == 'HTTP 503'
+    finally:
+        server.shutdown()
+
+
+def test_wind_monthly_raises_when_every_buoy_fails(pipeline, ndbc_url):
+    os.makedirs('data')
+    tasks = [(benchmark.MISSING_BUOY, year, 'North') for year in [2010, 2011]]
+    with pytest.raises(RuntimeError, match="all 2 buoy-years failed"):
+        pipeline.wind_monthly(tasks, base_url=ndbc_url, cache_dir='ndbc')
+    assert len(pd.read_csv('data/PR_Wind_failures.csv')) == 2
+
+
+def test_wind_monthly(pipeline, ndbc_url):
+    os.makedirs('data')
+    tasks = [('sjnp4', 2010, 'North'), ('ptrp4', 2010, 'West'), (benchmark.MISSING_BUOY, 2010, 'North')]
+    wind = pipeline.wind_monthly(tasks, base_url=ndbc_url, cache_dir='ndbc')
+    assert wind[['year', 'month', 'region']].values.tolist() == [[2010, 1, 'North'], [2010, 1, 'West']]
+    assert wind['WSPD'].between(0, 12).all()
+
+
+def test_wind_monthly_prunes_years_and_regions(pipeline, ndbc_url):
+    os.makedirs('data')
+    tasks = [('sjnp4', 2010, 'North'), ('sjnp4', 2011, 'North'), ('ptrp4', 2011, 'West')]
+    wind = pipeline.wind_monthly(tasks, start_year=2011, regions=['North'], base_url=ndbc_url, cache_dir='ndbc')
+    assert wind[['year', 'month', 'region']].values.tolist() == [[2011, 1, 'North']]